@@ -63,6 +63,9 @@ setuptools.setup(
         'unsync',
     ],
     extras_require={
+        'brotli': [
+            'brotli',
+        ],
         'dev': [
             'aiohttp-devtools',
             'aioresponses',
@@ -1,32 +1,24 @@
+import asyncio
 import enum
 import functools
+import importlib
 import json
 import logging
+import multiprocessing
+import multiprocessing.connection
 import pathlib
 import tempfile
 from os import environ
 
 import aiohttp.web
-import aiohttp_graphql
 import graphene
-import pkg_resources
 from graphql.error import format_error as format_graphql_error
 from graphql.execution.executors.asyncio import AsyncioExecutor
 from spherical.dev.log import init_logging
 
-from . import proxy, repo, schema
+from . import metrics, profiling, proxy, repo, schema, static, tracing, view
 from .auth0 import Auth0Client, FakeAuth0Client
 from .jwt import GraphExecutionError, JWTMiddleware
-from .repo.local import (
-    AsyncDockerServer,
-    AsyncDockerServerLectern,
-    AsyncLocalServer,
-    FakeServer,
-    FileStorage,
-    GitlabStorage,
-    GitStorage,
-    LocalLektor,
-)
 from .utils import closer
 
 
@@ -41,26 +33,35 @@ class BaseEnum(enum.Enum):
         return cls[name]
 
 
+class ImportEnum(BaseEnum):
+    @property
+    def cls(self):
+        module, _, name = self.value.rpartition('.')
+        return getattr(importlib.import_module(module), name)
+
+
 class RepoType(BaseEnum):
     LIST = enum.auto()
     LOCAL = enum.auto()
 
 
-class StorageType(BaseEnum):
-    FILE = FileStorage
-    GIT = GitStorage
-    GITLAB = GitlabStorage
+class StorageType(ImportEnum):
+    FILE = 'lektorium.repo.local.storage.FileStorage'
+    GIT = 'lektorium.repo.local.storage.GitStorage'
+    GITLAB = 'lektorium.repo.local.storage.GitlabStorage'
 
 
-class ServerType(BaseEnum):
-    FAKE = FakeServer
-    ASYNC = AsyncLocalServer
-    DOCKER = AsyncDockerServer
-    LECTERN = AsyncDockerServerLectern
+class ServerType(ImportEnum):
+    FAKE = 'lektorium.repo.local.server.FakeServer'
+    ASYNC = 'lektorium.repo.local.server.AsyncLocalServer'
+    DOCKER = 'lektorium.repo.local.server.AsyncDockerServer'
+    LECTERN = 'lektorium.repo.local.server.AsyncDockerServerLectern'
 
 
-def create_app(repo_type=RepoType.LIST, auth='', repo_args=''):
+def create_app(repo_type=RepoType.LIST, auth='', repo_args='', workers=1):
     init_logging()
+    tracing.install_logging()
+    tracing.configure()
     auth0_client, auth0_options = None, None
     if auth:
         auth_attributes = ('domain', 'id', 'api', 'management-id', 'management-secret')
@@ -72,6 +73,8 @@ def create_app(repo_type=RepoType.LIST, auth='', repo_args=''):
     if repo_type == RepoType.LIST:
         if repo_args:
             raise ValueError('LIST repo does not support arguments')
+        if workers > 1:
+            raise ValueError('LIST repo does not support multiple workers')
         lektorium_repo = repo.ListRepo(repo.SITES)
         if auth0_client is None:
             auth0_client = FakeAuth0Client()
@@ -82,33 +85,42 @@ def create_app(repo_type=RepoType.LIST, auth='', repo_args=''):
         server_type, _, options = server_type.partition(':')
         options = {k: v for k, v in (x.split('=') for x in options.split(':') if x)}
         server_type = ServerType.get(server_type or 'FAKE')
-        server = server_type.value(**options)
+        server = server_type.cls(**options)
 
         protocol = protocol or 'https'
         storage_config = storage_config or 'FILE'
         storage_type, _, storage_path = storage_config.partition('=')
-        storage_class = StorageType.get(storage_type).value
+        storage_type = StorageType.get(storage_type)
+        storage_class = storage_type.cls
         if not storage_path:
             storage_path = pathlib.Path(closer(tempfile.TemporaryDirectory()))
             storage_path = storage_class.init(storage_path)
-        if storage_class is GitlabStorage:
+        if storage_type is StorageType.GITLAB:
             skip_aws = True if environ.get('LEKTORIUM_SKIP_AWS', '') == 'YES' else False
             storage = storage_class(storage_path, token, protocol, skip_aws)
         else:
             storage = storage_class(pathlib.Path(storage_path))
 
         sessions_root = None
+        state_path = environ.get('LEKTORIUM_STATE_FILE', None)
         if server_type in (ServerType.DOCKER, ServerType.LECTERN):
             sessions_root = pathlib.Path('/sessions')
             if not sessions_root.exists():
                 raise RuntimeError('/sessions not exists')
+            state_name = '.lektorium-state.sqlite' if workers > 1 else '.lektorium-state.json'
+            state_path = state_path or sessions_root / state_name
+        elif workers > 1:
+            raise ValueError('multiple workers require DOCKER or LECTERN server')
 
         lektorium_repo = repo.LocalRepo(
             storage,
             server,
-            LocalLektor,
+            repo.local.LocalLektor,
             sessions_root=sessions_root,
+            state_path=state_path,
         )
+        if workers > 1 and not lektorium_repo.shared:
+            raise ValueError('multiple workers require SQLite LEKTORIUM_STATE_FILE')
     else:
         raise ValueError(f'repo_type not supported {repo_type}')
 
@@ -116,10 +128,46 @@ def create_app(repo_type=RepoType.LIST, auth='', repo_args=''):
     return init_app(lektorium_repo, auth0_options, auth0_client)
 
 
+def watch_repo_state(repo):
+    async def watch_state(app):
+        if getattr(repo, 'shared', False):
+            app['watch_state'] = asyncio.ensure_future(repo.watch_state())
+
+    async def unwatch_state(app):
+        if 'watch_state' in app:
+            app['watch_state'].cancel()
+    return watch_state, unwatch_state
+
+
+def monitor_loop(monitor):
+    async def start_monitor(app):
+        monitor.start()
+
+    async def stop_monitor(app):
+        await monitor.stop()
+    return start_monitor, stop_monitor
+
+
 async def log_application_ready(app):
     logging.getLogger('lektorium').info('Lektorium started')
 
 
+def warm_up_server(repo):
+    async def warm_up(app):
+        warm_up = getattr(getattr(repo, 'server', None), 'warm_up', None)
+        if callable(warm_up):
+            warm_up()
+    return warm_up
+
+
+def reconcile_repo(repo):
+    async def start_reconcile(app):
+        start_reconcile = getattr(repo, 'start_reconcile', None)
+        if callable(start_reconcile):
+            start_reconcile()
+    return start_reconcile
+
+
 def error_formatter(error):
     formatted = format_graphql_error(error)
     if hasattr(error, 'original_error'):
@@ -128,21 +176,73 @@ def error_formatter(error):
     return formatted
 
 
-async def docker_handler(authorizer, request):
+async def check_admin(authorizer, request):
     _, permissions = await authorizer.info(request)
     if schema.ADMIN not in permissions:
         raise aiohttp.web.HTTPUnauthorized()
-    await proxy.handler('/var/run/docker.sock', request)
 
 
-def init_app(repo, auth0_options=None, auth0_client=None):
-    app = aiohttp.web.Application(handler_args={'max_field_size': 16394})
+async def docker_handler(authorizer, docker_proxy, request):
+    await check_admin(authorizer, request)
+    return await docker_proxy.handler(request)
+
+
+async def admin_handler(authorizer, handler, request):
+    await check_admin(authorizer, request)
+    return await handler(request)
+
+
+EVENTS_AUTH_TIMEOUT = 10
+EVENTS_UNAUTHORIZED = 4401
 
-    client_dir = pkg_resources.resource_filename(__name__, 'client')
-    client_dir = pathlib.Path(client_dir).resolve()
 
-    async def index(request):
-        return aiohttp.web.FileResponse(client_dir / 'public' / 'index.html')
+async def websocket_permissions(authorizer, websocket):
+    try:
+        message = await websocket.receive_json(timeout=EVENTS_AUTH_TIMEOUT)
+        _, permissions = await authorizer.verify({'Authorization': f'Bearer {message["token"]}'})
+    except (asyncio.TimeoutError, GraphExecutionError, KeyError, TypeError, ValueError):
+        return None
+    return permissions
+
+
+async def websocket_closed(websocket):
+    async for _ in websocket:
+        pass
+
+
+async def events_handler(repo, authorizer, request):
+    websocket = aiohttp.web.WebSocketResponse(heartbeat=30)
+    await websocket.prepare(request)
+    permissions = (schema.ADMIN,)
+    if authorizer is not None:
+        permissions = await websocket_permissions(authorizer, websocket)
+        if permissions is None:
+            await websocket.close(code=EVENTS_UNAUTHORIZED, message=b'Unauthorized')
+            return websocket
+    with repo.events.subscribe() as queue:
+        closed = asyncio.ensure_future(websocket_closed(websocket))
+        while not closed.done():
+            event = asyncio.ensure_future(queue.get())
+            await asyncio.wait((event, closed), return_when=asyncio.FIRST_COMPLETED)
+            if not event.done():
+                event.cancel()
+                break
+            event = event.result()
+            if event['site_id'] is None or schema.has_site_permission(permissions, event['site_id']):
+                await websocket.send_json(event)
+        closed.cancel()
+    await websocket.close()
+    return websocket
+
+
+def init_app(repo, auth0_options=None, auth0_client=None):
+    app = aiohttp.web.Application(
+        handler_args={'max_field_size': 16394},
+        middlewares=[tracing.request_middleware],
+    )
+
+    client_dir = pathlib.Path(__file__).resolve().parent / 'client'
+    assets = static.StaticAssets(client_dir)
 
     async def auth0_config(request):
         options = (
@@ -154,27 +254,33 @@ def init_app(repo, auth0_options=None, auth0_client=None):
             content_type='application/javascript',
         )
 
-    app.router.add_route('*', '/', index)
-    app.router.add_route('*', '/callback', index)
-    app.router.add_route('*', '/logs', index)
-    app.router.add_route('*', '/profile', index)
+    app.router.add_route('*', '/', assets.index_handler)
+    app.router.add_route('*', '/callback', assets.index_handler)
+    app.router.add_route('*', '/logs', assets.index_handler)
+    app.router.add_route('*', '/profile', assets.index_handler)
     app.router.add_route('GET', '/auth0-config', auth0_config)
-    app.router.add_static('/components', client_dir / 'components')
-    app.router.add_static('/images', client_dir / 'images')
-    app.router.add_static('/scripts', client_dir / 'scripts')
+    assets.register(app.router)
 
-    middleware = []
+    monitor = profiling.LoopMonitor(
+        threshold=float(environ.get('LEKTORIUM_LOOP_THRESHOLD', profiling.LoopMonitor.THRESHOLD)),
+    )
+    middleware, authorizer = [metrics.ResolverMetrics()], None
     if auth0_options is not None:
         authorizer = JWTMiddleware(auth0_options['data-auth0-domain'])
         middleware.append(authorizer)
         app.router.add_route(
             'GET',
             '/docker',
-            functools.partial(docker_handler, authorizer),
+            functools.partial(docker_handler, authorizer, proxy.DockerProxy('/var/run/docker.sock')),
         )
+        for method, path, handler in profiling.DebugHandlers(monitor=monitor).routes():
+            app.router.add_route(method, path, functools.partial(admin_handler, authorizer, handler))
+    app.router.add_route('GET', '/events', functools.partial(events_handler, repo, authorizer))
+    app.router.add_get('/metrics', metrics.REGISTRY.handler)
 
-    aiohttp_graphql.GraphQLView.attach(
+    view.GraphQLView.attach(
         app,
+        authorizer=authorizer,
         schema=graphene.Schema(
             query=schema.Query,
             mutation=schema.MutationQuery,
@@ -191,17 +297,44 @@ def init_app(repo, auth0_options=None, auth0_client=None):
     )
 
     app.on_startup.append(log_application_ready)
+    app.on_startup.append(warm_up_server(repo))
+    app.on_startup.append(reconcile_repo(repo))
+    watch_state, unwatch_state = watch_repo_state(repo)
+    app.on_startup.append(watch_state)
+    app.on_cleanup.append(unwatch_state)
+    start_monitor, stop_monitor = monitor_loop(monitor)
+    app.on_startup.append(start_monitor)
+    app.on_cleanup.append(stop_monitor)
 
     return app
 
 
-def main(repo_type='', auth=''):
+def serve_worker(app_factory, port):
+    aiohttp.web.run_app(app_factory(), port=port, reuse_port=True)
+
+
+def run_workers(app_factory, workers, port=8000):
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=serve_worker, args=(app_factory, port)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        multiprocessing.connection.wait([x.sentinel for x in processes])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+    return max(abs(x.exitcode or 0) for x in processes)
+
+
+def main(repo_type='', auth='', workers=''):
     repo_type, _, repo_args = repo_type.partition(':')
-    aiohttp.web.run_app(
-        create_app(
-            RepoType.get(repo_type),
-            auth,
-            repo_args,
-        ),
-        port=8000,
-    )
+    workers = int(workers or environ.get('LEKTORIUM_WORKERS', '1'))
+    app_factory = functools.partial(create_app, RepoType.get(repo_type), auth, repo_args, workers)
+    if workers > 1:
+        raise SystemExit(run_workers(app_factory, workers))
+    aiohttp.web.run_app(app_factory(), port=8000)
@@ -1,10 +1,76 @@
 import asyncio
+import collections
+import functools
 import time
 
 import wrapt
 from aiohttp import ClientSession
 from cached_property import cached_property
 
+from . import metrics
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, stale_period=0):
+        self.maxsize = maxsize
+        self.stale_period = stale_period
+        self.entries = collections.OrderedDict()
+        self.pending = {}
+        self.metrics = collections.Counter()
+
+    async def get(self, key, loader, timeout=None):
+        if key in self.entries:
+            value, stored_on = self.entries[key]
+            age = time.time() - stored_on
+            if timeout is None or age <= timeout:
+                self.metrics['hits'] += 1
+                self.entries.move_to_end(key)
+                return value
+            if age <= timeout + self.stale_period:
+                self.metrics['stale'] += 1
+                self.load(key, loader)
+                return value
+            del self.entries[key]
+        self.metrics['misses'] += 1
+        return await asyncio.shield(self.load(key, loader))
+
+    def load(self, key, loader):
+        if key in self.pending:
+            self.metrics['coalesced'] += 1
+        else:
+            future = asyncio.ensure_future(loader())
+            future.add_done_callback(functools.partial(self.loaded, key))
+            self.pending[key] = future
+        return self.pending[key]
+
+    def loaded(self, key, future):
+        if self.pending.get(key, None) is not future:
+            return
+        del self.pending[key]
+        if future.cancelled() or future.exception() is not None:
+            self.metrics['errors'] += 1
+            return
+        self.entries[key] = (future.result(), time.time())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.metrics['evictions'] += 1
+
+    def pop(self, key, default=None):
+        self.pending.pop(key, None)
+        result = self.entries.pop(key, None)
+        return default if result is None else result[0]
+
+    def clear(self):
+        self.pending.clear()
+        self.entries.clear()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
 
 def cacher(method_alias, timeout=None):
     @wrapt.decorator
@@ -12,14 +78,7 @@ def cacher(method_alias, timeout=None):
         if kwargs:
             raise Exception('Cannot use keyword args')
         key = (method_alias, *args)
-        if key in instance._cache:
-            _, cached_on = instance._cache[key]
-            if timeout is not None and time.time() - cached_on > timeout:
-                instance._cache.pop(key)
-        if key not in instance._cache:
-            instance._cache[key] = (await wrapped(*args), time.time())
-        result, _ = instance._cache[key]
-        return result
+        return await instance._cache.get(key, functools.partial(wrapped, *args), timeout)
     return wrapper
 
 
@@ -79,34 +138,88 @@ class FakeAuth0Client:
         return self.api_permissions
 
 
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.reset_time = None
+
+    def refill(self):
+        now = time.monotonic()
+        if self.reset_time is not None and time.time() >= self.reset_time:
+            self.tokens, self.reset_time = self.capacity, None
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        self.refill()
+        if self.reset_time is not None:
+            return max(self.reset_time - time.time(), 0.01)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        delay = self.delay()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = self.delay()
+
+    def update(self, headers):
+        limit = headers.get('X-RateLimit-Limit', None)
+        remaining = headers.get('X-RateLimit-Remaining', None)
+        reset = headers.get('X-RateLimit-Reset', None)
+        self.refill()
+        if limit is not None:
+            self.capacity = max(int(limit), 1)
+        if remaining is not None:
+            self.tokens = min(self.tokens, int(remaining))
+            if int(remaining) < 1 and reset is not None:
+                self.reset_time = int(reset)
+
+
 class ThrottledClientSession(ClientSession):
-    DELAY = 0.6
+    RATE = 2
+    BURST = 10
+    MAX_IN_FLIGHT = 10
+    ATTEMPTS = 3
 
-    def __init__(self, *args, **kwargs):
-        self.last_request_time = time.time()
-        super().__init__(*args, **kwargs)
+    @cached_property
+    def bucket(self):
+        return TokenBucket(self.RATE, self.BURST)
 
     @cached_property
-    def lock(self):
-        return asyncio.Lock()
+    def in_flight(self):
+        return asyncio.Semaphore(self.MAX_IN_FLIGHT)
 
-    async def _request(self, *args, **kwargs):
-        async with self.lock:
-            sleep_time = self.last_request_time + self.DELAY - time.time()
-            if sleep_time > 0:
-                await asyncio.sleep(sleep_time)
-            self.last_request_time = time.time()
-            return await super()._request(*args, **kwargs)
+    async def _request(self, method, *args, **kwargs):
+        async with self.in_flight:
+            for attempt in range(1, self.ATTEMPTS + 1):
+                await self.bucket.acquire()
+                with metrics.HTTP_SECONDS.time(service='auth0', method=method):
+                    response = await super()._request(method, *args, **kwargs)
+                metrics.HTTP_REQUESTS.inc(service='auth0', method=method, status=response.status)
+                self.bucket.update(response.headers)
+                if response.status != 429 or attempt == self.ATTEMPTS:
+                    return response
+                response.release()
 
 
 class Auth0Client:
     CACHE_VALID_PERIOD = 60
+    TOKEN_REFRESH_MARGIN = 300
+    USERS_PAGE_SIZE = 100
     CACHE_USERS_ALIAS = 'users'
     CACHE_USER_PERMISSIONS_ALIAS = 'user_permissions'
     CACHE_API_PERMISSIONS_ALIAS = 'api_permissions'
+    CACHE_SIZE = 4096
+    CACHE_STALE_PERIOD = 60
 
     def __init__(self, auth):
-        self._cache = dict()
+        self._cache = LRUCache(self.CACHE_SIZE, self.CACHE_STALE_PERIOD)
         self.base_url = f'https://{auth["data-auth0-domain"]}'
         self.token_url = f'{self.base_url}/oauth/token'
         self.api_id = auth['data-auth0-api']
@@ -118,7 +231,10 @@ class Auth0Client:
             'grant_type': 'client_credentials',
         }
         self.token = None
-        self.token_time = time.time() + self.CACHE_VALID_PERIOD
+        self.token_expires = 0
+        self.token_refresh_time = 0
+        self.token_refresh = None
+        self.token_timer = None
 
     @cached_property
     def session(self):
@@ -126,16 +242,37 @@ class Auth0Client:
 
     @property
     async def auth_token(self):
-        if self.token is not None:
-            if time.time() - self.token_time < self.CACHE_VALID_PERIOD:
-                return self.token
+        now = time.time()
+        if self.token is not None and now < self.token_expires:
+            if now >= self.token_refresh_time:
+                self.refresh_token()
+            return self.token
+        return await asyncio.shield(self.refresh_token())
+
+    def refresh_token(self):
+        if self.token_refresh is None:
+            self.token_refresh = asyncio.ensure_future(self.fetch_token())
+            self.token_refresh.add_done_callback(self.token_refreshed)
+        return self.token_refresh
+
+    def token_refreshed(self, future):
+        self.token_refresh = None
+        if not future.cancelled():
+            future.exception()
+
+    async def fetch_token(self):
         async with self.session.post(self.token_url, json=self.data) as resp:
             if resp.status != 200:
-                self.token = None
                 raise Auth0Error(f'Error {resp.status}')
             result = await resp.json()
-            self.token = result['access_token']
-        self.token_time = time.time()
+        lifetime = result.get('expires_in', self.CACHE_VALID_PERIOD)
+        refresh_in = max(lifetime - self.TOKEN_REFRESH_MARGIN, lifetime / 2)
+        self.token = result['access_token']
+        self.token_expires = time.time() + lifetime
+        self.token_refresh_time = time.time() + refresh_in
+        if self.token_timer is not None:
+            self.token_timer.cancel()
+        self.token_timer = asyncio.get_event_loop().call_later(refresh_in, self.refresh_token)
         return self.token
 
     @property
@@ -145,19 +282,29 @@ class Auth0Client:
 
     @cacher(CACHE_USERS_ALIAS, 300)
     async def get_users(self):
-        params = {'fields': 'name,nickname,email,user_id', 'per_page': 100}
+        users, page = [], 0
         url = f'{self.audience}/users'
-        async with self.session.get(url, params=params, headers=await self.auth_headers) as resp:
-            if resp.status != 200:
-                raise Auth0Error(f'Error {resp.status}')
-            users = await resp.json()
-            for user in users:
-                if user.get('user_id'):
-                    permissions = await self.get_user_permissions(user['user_id'])
-                    user['permissions'] = [permission['permission_name'] for permission in permissions]
-            return users
-
-    @cacher(CACHE_USER_PERMISSIONS_ALIAS)
+        while True:
+            params = {
+                'fields': 'name,nickname,email,user_id',
+                'per_page': self.USERS_PAGE_SIZE,
+                'page': page,
+            }
+            async with self.session.get(url, params=params, headers=await self.auth_headers) as resp:
+                if resp.status != 200:
+                    raise Auth0Error(f'Error {resp.status}')
+                batch = await resp.json()
+            users.extend(batch)
+            if len(batch) < self.USERS_PAGE_SIZE:
+                break
+            page += 1
+        users_with_id = [user for user in users if user.get('user_id')]
+        permissions = await asyncio.gather(*(self.get_user_permissions(x['user_id']) for x in users_with_id))
+        for user, user_permissions in zip(users_with_id, permissions):
+            user['permissions'] = [permission['permission_name'] for permission in user_permissions]
+        return users
+
+    @cacher(CACHE_USER_PERMISSIONS_ALIAS, 300)
     async def get_user_permissions(self, user_id):
         params = {'per_page': 100}
         url = f'{self.audience}/users/{user_id}/permissions'
@@ -185,7 +332,6 @@ class Auth0Client:
             return True
 
     async def delete_user_permissions(self, user_id, permissions):
-        self._cache.clear()
         data = {'permissions': []}
         for permission in permissions:
             data['permissions'].append({
@@ -200,7 +346,7 @@ class Auth0Client:
             self._cache.pop((self.CACHE_USERS_ALIAS,), None)
             return True
 
-    @cacher(CACHE_API_PERMISSIONS_ALIAS)
+    @cacher(CACHE_API_PERMISSIONS_ALIAS, 3600)
     async def get_api_permissions(self):
         params = {'per_page': 100}
         url = f'{self.audience}/resource-servers'
@@ -1,9 +1,13 @@
 from time import sleep
 from uuid import uuid4
 
-import boto3
 from cached_property import cached_property
 
+from .utils import lazy_import
+
+
+boto3 = lazy_import('boto3')
+
 
 BUCKET_POLICY_TEMPLATE = '''{{
     "Version": "2012-10-17",
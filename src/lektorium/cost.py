@@ -0,0 +1,143 @@
+import collections
+import time
+
+from graphql.language import ast
+from graphql.type.definition import GraphQLList, GraphQLNonNull
+
+
+class QueryCost:
+    DEFAULT_WEIGHT = 1
+    LIST_SIZE = 10
+    WEIGHTS = {
+        'Query.themes': 20,
+        'Query.releasing': 20,
+        'Query.users': 10,
+        'Query.userPermissions': 5,
+        'Query.jobs': 5,
+        'Session.themes': 5,
+        'MutationQuery.createSession': 50,
+        'MutationQuery.createSite': 50,
+        'MutationQuery.requestRelease': 50,
+        'MutationQuery.destroySession': 20,
+        'MutationQuery.parkSession': 20,
+        'MutationQuery.unparkSession': 20,
+        'MutationQuery.setUserPermissions': 10,
+        'MutationQuery.deleteUserPermissions': 10,
+    }
+
+    def __init__(self, schema, weights=None, list_size=LIST_SIZE):
+        self.schema = schema
+        self.weights = dict(self.WEIGHTS, **(weights or {}))
+        self.list_size = list_size
+
+    def analyze(self, document, operation_name=None, variables=None):
+        definitions = document.document_ast.definitions
+        fragments = {x.name.value: x for x in definitions if isinstance(x, ast.FragmentDefinition)}
+        operations = [x for x in definitions if isinstance(x, ast.OperationDefinition)]
+        if operation_name:
+            operations = [x for x in operations if x.name and x.name.value == operation_name]
+        if len(operations) != 1:
+            return 0, 0
+        operation = operations[0]
+        root = {
+            'query': self.schema.get_query_type(),
+            'mutation': self.schema.get_mutation_type(),
+        }.get(operation.operation, None)
+        if root is None:
+            return 0, 0
+        return self.selection_cost(root, operation.selection_set, fragments, variables or {}, 0, frozenset())
+
+    def selection_cost(self, parent, selection_set, fragments, variables, depth, spread):
+        cost, max_depth = 0, depth
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                name = selection.name.value
+                if name.startswith('__'):
+                    continue
+                field = getattr(parent, 'fields', {}).get(name, None)
+                field_type, is_list = self.unwrap(field.type) if field is not None else (None, False)
+                child_cost, child_depth = 0, depth + 1
+                if selection.selection_set is not None and field_type is not None:
+                    child_cost, child_depth = self.selection_cost(
+                        field_type,
+                        selection.selection_set,
+                        fragments,
+                        variables,
+                        depth + 1,
+                        spread,
+                    )
+                multiplier = self.multiplier(selection, variables) if is_list else 1
+                cost += self.weights.get(f'{parent.name}.{name}', self.DEFAULT_WEIGHT) + multiplier * child_cost
+                max_depth = max(max_depth, child_depth)
+                continue
+            if isinstance(selection, ast.FragmentSpread):
+                name = selection.name.value
+                if name in spread or name not in fragments:
+                    continue
+                fragment, fragment_spread = fragments[name], spread | {name}
+            else:
+                fragment, fragment_spread = selection, spread
+            fragment_type = parent
+            if fragment.type_condition is not None:
+                fragment_type = self.schema.get_type(fragment.type_condition.name.value) or parent
+            fragment_cost, fragment_depth = self.selection_cost(
+                fragment_type,
+                fragment.selection_set,
+                fragments,
+                variables,
+                depth,
+                fragment_spread,
+            )
+            cost += fragment_cost
+            max_depth = max(max_depth, fragment_depth)
+        return cost, max_depth
+
+    def multiplier(self, field, variables):
+        for argument in field.arguments or ():
+            if argument.name.value != 'first':
+                continue
+            value = argument.value
+            if isinstance(value, ast.Variable):
+                value = variables.get(value.name.value, None)
+            elif isinstance(value, ast.IntValue):
+                value = int(value.value)
+            if isinstance(value, int):
+                return max(value, 0)
+        return self.list_size
+
+    @staticmethod
+    def unwrap(field_type):
+        is_list = False
+        while isinstance(field_type, (GraphQLList, GraphQLNonNull)):
+            is_list = is_list or isinstance(field_type, GraphQLList)
+            field_type = field_type.of_type
+        return field_type, is_list
+
+
+class CostLimiter:
+    RATE = 100
+    BURST = 3000
+    MAX_DELAY = 5
+    SIZE = 4096
+
+    def __init__(self, rate=RATE, burst=BURST, max_delay=MAX_DELAY, size=SIZE):
+        self.rate = rate
+        self.burst = burst
+        self.max_delay = max_delay
+        self.size = size
+        self.buckets = collections.OrderedDict()
+
+    def reserve(self, key, cost):
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - cost
+        delay = max(-tokens / self.rate, 0)
+        if delay > self.max_delay:
+            tokens += cost
+        self.buckets[key] = (tokens, now)
+        while len(self.buckets) > self.size:
+            self.buckets.popitem(last=False)
+        return delay
+
+    def __len__(self):
+        return len(self.buckets)
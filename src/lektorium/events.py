@@ -0,0 +1,29 @@
+import asyncio
+import contextlib
+import time
+
+
+class EventBus:
+    QUEUE_SIZE = 256
+
+    def __init__(self):
+        self.queues = set()
+
+    def publish(self, event, **data):
+        message = dict(event=event, time=time.time(), **data)
+        for queue in tuple(self.queues):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    @contextlib.contextmanager
+    def subscribe(self):
+        queue = asyncio.Queue(self.QUEUE_SIZE)
+        self.queues.add(queue)
+        try:
+            yield queue
+        finally:
+            self.queues.discard(queue)
+
+    def __len__(self):
+        return len(self.queues)
@@ -1,33 +1,149 @@
+import asyncio
+import base64
+import collections
+import hashlib
+import json
+import logging
+import time
+
 import aiohttp
-from authlib.jose import JsonWebToken
-from authlib.jose.errors import JoseError
-from cached_property import cached_property
 from graphql import GraphQLError
 
+from . import metrics
+from .utils import lazy_import
+
+
+jose = lazy_import('authlib.jose')
+
+
+class JWKS:
+    TTL = 3600
+    REFETCH_INTERVAL = 30
+
+    def __init__(self, url):
+        self.url = url
+        self.document = None
+        self.keys = {}
+        self.fetched = 0
+        self.fetching = None
+
+    async def fetch(self):
+        async with aiohttp.ClientSession() as client:
+            async with client.get(self.url) as resp:
+                return await resp.json()
+
+    def load(self, document):
+        keys = {}
+        if isinstance(document, dict):
+            for key in document.get('keys', [document]):
+                try:
+                    keys[key.get('kid', None)] = jose.JsonWebKey.import_key(key)
+                except (AttributeError, jose.JoseError, KeyError, TypeError, ValueError):
+                    continue
+        self.document, self.keys, self.fetched = document, keys, time.time()
+
+    async def update(self):
+        try:
+            self.load(await self.fetch())
+        finally:
+            self.fetching = None
+
+    def refresh(self):
+        if self.fetching is None:
+            self.fetching = asyncio.ensure_future(self.update())
+            self.fetching.add_done_callback(self.log_failure)
+        return self.fetching
+
+    @staticmethod
+    def log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.getLogger('lektorium').warning(f'JWKS refresh failed: {future.exception()}')
+
+    async def key(self, kid):
+        if self.document is None:
+            await asyncio.shield(self.refresh())
+        elif time.time() - self.fetched > self.TTL:
+            self.refresh()
+        if kid not in self.keys and time.time() - self.fetched > self.REFETCH_INTERVAL:
+            await asyncio.shield(self.refresh())
+        if kid not in self.keys:
+            raise GraphExecutionError('Unable to find token signing key', code=401)
+        return self.keys[kid]
+
+    @staticmethod
+    def token_kid(token):
+        try:
+            header = token.split('.')[0]
+            header = base64.urlsafe_b64decode(header + '=' * (-len(header) % 4))
+            return json.loads(header).get('kid', None)
+        except (AttributeError, TypeError, ValueError):
+            return None
+
 
 class JWTMiddleware:
+    CONTEXT_KEY = 'jwt_info'
+    VERIFIED_CACHE_SIZE = 1024
+    VERIFIED_CACHE_TTL = 300
+
     def __init__(self, auth0_domain):
         if not (auth0_domain and auth0_domain.endswith('.auth0.com')):
             raise ValueError('wrong auth0 domain')
         self.auth0_domain = auth0_domain
+        self.verified = collections.OrderedDict()
+        self.jwks = JWKS(f'https://{auth0_domain}/.well-known/jwks.json')
 
     async def resolve(self, next, root, info, **kwargs):
-        userdata, permissions = await self.info(info.context['request'])
+        if self.CONTEXT_KEY not in info.context:
+            info.context[self.CONTEXT_KEY] = asyncio.ensure_future(
+                self.info(info.context['request']),
+            )
+        userdata, permissions = await info.context[self.CONTEXT_KEY]
         if userdata is not None:
             info.context['userdata'] = userdata
         info.context['user_permissions'] = permissions
         return next(root, info, **kwargs)
 
     async def info(self, request):
-        token, extra = self.get_token_auth(request.headers)
-        key = await self.public_key
-        payload = self.decode_token(token, key)
-        permissions = self.decode_token(extra, key).get('permissions', [])
+        return await self.verify(request.headers)
+
+    async def verify(self, headers):
+        with metrics.JWT_SECONDS.time(cached='false') as labels:
+            token, extra = self.get_token_auth(headers)
+            digest = hashlib.sha256(f'{token}.{extra}'.encode()).digest()
+            result = self.lookup_verified(digest)
+            if result is not None:
+                labels['cached'] = 'true'
+                return result
+            return await self.verify_token(token, extra, digest)
+
+    async def verify_token(self, token, extra, digest):
+        payload = self.decode_token(token, await self.jwks.key(JWKS.token_kid(token)))
+        extra_payload = self.decode_token(extra, await self.jwks.key(JWKS.token_kid(extra)))
+        permissions = extra_payload.get('permissions', [])
         userdata = None
         if payload:
             userdata = (payload['nickname'], payload['email'])
+        expires = [time.time() + self.VERIFIED_CACHE_TTL]
+        expires.extend(x['exp'] for x in (payload, extra_payload) if x.get('exp') is not None)
+        self.store_verified(digest, (userdata, permissions), min(expires))
         return userdata, permissions
 
+    def lookup_verified(self, digest):
+        if digest not in self.verified:
+            return None
+        result, expires = self.verified[digest]
+        if expires <= time.time():
+            del self.verified[digest]
+            return None
+        self.verified.move_to_end(digest)
+        return result
+
+    def store_verified(self, digest, result, expires):
+        self.verified[digest] = (result, expires)
+        self.verified.move_to_end(digest)
+        while len(self.verified) > self.VERIFIED_CACHE_SIZE:
+            self.verified.popitem(last=False)
+
     def get_token_auth(self, headers):
         """Obtains the Access Token from the Authorization Header"""
         auth = headers.get('Authorization', None)
@@ -51,20 +167,19 @@ class JWTMiddleware:
 
         return token, extra
 
-    @cached_property
+    @property
     async def public_key(self):
-        async with aiohttp.ClientSession() as client:
-            jwks_url = f'https://{self.auth0_domain}/.well-known/jwks.json'
-            async with client.get(jwks_url) as resp:
-                return await resp.json()
+        if self.jwks.document is None:
+            await self.jwks.refresh()
+        return self.jwks.document
 
     def decode_token(self, token, key):
-        jwt = JsonWebToken(['RS256'])
+        jwt = jose.JsonWebToken(['RS256'])
         try:
             claims = jwt.decode(token, key)
             claims.validate()
             return claims
-        except JoseError as e:
+        except jose.JoseError as e:
             raise GraphExecutionError(
                 f'Unable to decode token: {e.error}',
                 code=401,
@@ -0,0 +1,47 @@
+import asyncio
+
+
+class DataLoader:
+    def __init__(self, batch_load):
+        self.batch_load = batch_load
+        self.cache = {}
+        self.queue = []
+
+    def load(self, key):
+        if key not in self.cache:
+            loop = asyncio.get_event_loop()
+            self.cache[key] = loop.create_future()
+            if not self.queue:
+                loop.call_soon(self.dispatch)
+            self.queue.append(key)
+        return self.cache[key]
+
+    def load_many(self, keys):
+        return asyncio.gather(*(self.load(key) for key in keys))
+
+    def prime(self, key, value):
+        if key not in self.cache:
+            self.cache[key] = asyncio.get_event_loop().create_future()
+            self.cache[key].set_result(value)
+
+    def dispatch(self):
+        keys, self.queue = self.queue, []
+        asyncio.ensure_future(self.run(keys))
+
+    async def run(self, keys):
+        try:
+            values = await self.batch_load(keys)
+            if len(values) != len(keys):
+                raise RuntimeError('batch load returned wrong number of values')
+        except Exception as exc:
+            for key in keys:
+                if not self.cache[key].done():
+                    self.cache[key].set_exception(exc)
+            return
+        for key, value in zip(keys, values):
+            if self.cache[key].done():
+                continue
+            if isinstance(value, Exception):
+                self.cache[key].set_exception(value)
+            else:
+                self.cache[key].set_result(value)
@@ -0,0 +1,229 @@
+import asyncio
+import bisect
+import contextlib
+import threading
+import time
+
+import aiohttp.web
+from promise import Promise
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} expects labels {self.labels}, got {tuple(labels)}')
+        return tuple(str(labels[x]) for x in self.labels)
+
+    @staticmethod
+    def escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def format_labels(self, key, **extra):
+        pairs = (*zip(self.labels, key), *extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{self.escape(v)}"' for k, v in pairs) + '}'
+
+    def samples(self):
+        raise NotImplementedError()
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.TYPE}'
+        with self.lock:
+            samples = list(self.samples())
+        for suffix, key, extra, value in samples:
+            yield f'{self.name}{suffix}{self.format_labels(key, **extra)} {value:g}'
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}("{self.name}")'
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield '', key, {}, value
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield '', key, {}, value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        if 'result' in self.labels:
+            labels.setdefault('result', 'ok')
+        started = time.perf_counter()
+        try:
+            yield labels
+        except BaseException:
+            if 'result' in self.labels and labels['result'] == 'ok':
+                labels['result'] = 'error'
+            raise
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, counts in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                total += count
+                yield '_bucket', key, {'le': f'{bound:g}' if bound != float('inf') else '+Inf'}, total
+            yield '_sum', key, {}, counts[-1]
+            yield '_count', key, {}, total
+
+
+class Registry:
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        return ''.join(f'{line}\n' for metric in self.metrics.values() for line in metric.render())
+
+    async def handler(self, request):
+        return aiohttp.web.Response(body=self.render().encode(), headers={'Content-Type': self.CONTENT_TYPE})
+
+    def __len__(self):
+        return len(self.metrics)
+
+
+class ResolverMetrics:
+    ROOT_TYPES = ('Query', 'MutationQuery')
+
+    def __init__(self, histogram=None):
+        self.histogram = histogram or RESOLVER_SECONDS
+
+    def resolve(self, next, root, info, **kwargs):
+        if info.parent_type.name not in self.ROOT_TYPES:
+            return next(root, info, **kwargs)
+        labels = dict(type=info.parent_type.name, field=info.field_name)
+        started = time.perf_counter()
+        result = next(root, info, **kwargs)
+        if asyncio.iscoroutine(result):
+            return self.wait(result, started, labels)
+        if isinstance(result, Promise):
+            return result.then(
+                lambda value: self.done(started, labels, value),
+                lambda error: self.done(started, labels, error=error),
+            )
+        return self.done(started, labels, result)
+
+    async def wait(self, result, started, labels):
+        try:
+            return self.done(started, labels, await result)
+        except Exception as error:
+            self.done(started, labels, error=error)
+
+    def done(self, started, labels, value=None, error=None):
+        self.histogram.observe(time.perf_counter() - started, result='ok' if error is None else 'error', **labels)
+        if error is not None:
+            raise error
+        return value
+
+
+REGISTRY = Registry()
+RESOLVER_SECONDS = REGISTRY.histogram(
+    'lektorium_graphql_resolver_seconds',
+    'GraphQL root field resolution time.',
+    ('type', 'field', 'result'),
+)
+MUTATION_SECONDS = REGISTRY.histogram(
+    'lektorium_mutation_seconds',
+    'Repository mutation time including transition locks.',
+    ('mutation', 'result'),
+)
+COMMAND_SECONDS = REGISTRY.histogram(
+    'lektorium_command_seconds',
+    'Storage subprocess (git) duration.',
+    ('command', 'result'),
+)
+DOCKER_SECONDS = REGISTRY.histogram(
+    'lektorium_docker_seconds',
+    'Docker API operation duration.',
+    ('operation', 'result'),
+)
+SESSION_START_SECONDS = REGISTRY.histogram(
+    'lektorium_session_start_seconds',
+    'Time from session start request until Lektor serves it.',
+    ('server', 'result'),
+)
+JWT_SECONDS = REGISTRY.histogram(
+    'lektorium_jwt_verify_seconds',
+    'JWT verification time.',
+    ('cached', 'result'),
+)
+HTTP_REQUESTS = REGISTRY.counter(
+    'lektorium_http_requests_total',
+    'Outgoing API requests.',
+    ('service', 'method', 'status'),
+)
+HTTP_SECONDS = REGISTRY.histogram(
+    'lektorium_http_request_seconds',
+    'Outgoing API request duration.',
+    ('service', 'method'),
+)
+LOOP_LAG_SECONDS = REGISTRY.gauge(
+    'lektorium_event_loop_lag_seconds',
+    'Event loop scheduling lag percentiles over the recent window.',
+    ('quantile',),
+)
+LOOP_BLOCKED = REGISTRY.counter(
+    'lektorium_event_loop_blocked_total',
+    'Callbacks that blocked the event loop longer than the threshold.',
+)
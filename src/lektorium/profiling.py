@@ -0,0 +1,258 @@
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime
+
+import aiohttp.web
+
+from . import metrics
+
+
+class SamplingProfiler:
+    INTERVAL = 0.005
+    MAX_DURATION = 60
+    MAX_DEPTH = 128
+
+    def __init__(self, interval=INTERVAL, max_duration=MAX_DURATION):
+        self.interval = interval
+        self.max_duration = max_duration
+        self.samples = collections.Counter()
+        self.sample_count = 0
+        self.started = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            raise RuntimeError('profiler is already running')
+        self.samples, self.sample_count = collections.Counter(), 0
+        self.started = time.monotonic()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='lektorium-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self.collapsed()
+
+    def run(self):
+        own = threading.get_ident()
+        deadline = self.started + self.max_duration
+        while not self.stopping.wait(self.interval) and time.monotonic() < deadline:
+            self.sample(own)
+
+    def sample(self, skip=None):
+        names = {x.ident: x.name for x in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == skip:
+                continue
+            self.samples[(names.get(thread_id, str(thread_id)), self.stack(frame))] += 1
+        self.sample_count += 1
+
+    def stack(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.MAX_DEPTH:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'.replace(';', ':'))
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def collapsed(self):
+        return ''.join(f'{thread};{stack} {count}\n' for (thread, stack), count in self.samples.most_common())
+
+    async def profile(self, duration):
+        self.start()
+        try:
+            await asyncio.sleep(min(duration, self.max_duration))
+        finally:
+            result = await asyncio.get_event_loop().run_in_executor(None, self.stop)
+        return result
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(interval={self.interval})'
+
+
+async def loop_lag(samples=5):
+    loop, result = asyncio.get_event_loop(), []
+    for _ in range(samples):
+        scheduled, called = loop.time(), loop.create_future()
+        loop.call_soon(called.set_result, None)
+        await called
+        result.append(loop.time() - scheduled)
+    return result
+
+
+def task_info(task):
+    coro = task.get_coro()
+    frames = task.get_stack(limit=1)
+    location = None
+    if frames:
+        location = f'{frames[0].f_code.co_filename}:{frames[0].f_lineno}'
+    return {
+        'name': getattr(task, 'get_name', lambda: None)(),
+        'coroutine': getattr(coro, '__qualname__', repr(coro)),
+        'location': location,
+        'done': task.done(),
+    }
+
+
+class LoopMonitor:
+    INTERVAL = 0.1
+    THRESHOLD = 0.25
+    WINDOW = 600
+    QUANTILES = (0.5, 0.9, 0.99, 1)
+    MAX_REPORTS = 20
+
+    def __init__(self, interval=INTERVAL, threshold=THRESHOLD, window=WINDOW):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = collections.deque(maxlen=window)
+        self.reports = collections.deque(maxlen=self.MAX_REPORTS)
+        self.beat = None
+        self.loop_thread = None
+        self.task = None
+        self.watchdog = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        if self.task is not None:
+            raise RuntimeError('loop monitor is already running')
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self.stopping.clear()
+        self.task = asyncio.ensure_future(self.heartbeat())
+        self.watchdog = threading.Thread(target=self.watch, name='lektorium-loop-watchdog', daemon=True)
+        self.watchdog.start()
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.stopping.set()
+        self.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.task
+        self.watchdog.join()
+        self.task = self.watchdog = None
+
+    async def heartbeat(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.beat = time.monotonic()
+            self.observe(max(loop.time() - expected, 0))
+
+    def observe(self, lag):
+        self.lags.append(lag)
+        for quantile, value in self.percentiles().items():
+            metrics.LOOP_LAG_SECONDS.set(value, quantile=quantile)
+
+    def percentiles(self):
+        lags = sorted(self.lags)
+        if not lags:
+            return {}
+        return {x: lags[min(int(x * len(lags)), len(lags) - 1)] for x in self.QUANTILES}
+
+    def watch(self):
+        reported = None
+        while not self.stopping.wait(min(self.interval, self.threshold / 2)):
+            beat = self.beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked > self.threshold and beat != reported:
+                reported = beat
+                self.report(blocked)
+
+    def report(self, blocked):
+        frame = sys._current_frames().get(self.loop_thread, None)
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+        metrics.LOOP_BLOCKED.inc()
+        self.reports.append({'time': datetime.now(), 'blocked': blocked, 'stack': stack})
+        logging.getLogger('lektorium.profiling').warning(f'Event loop blocked for {blocked:.3f}s at:\n{stack}')
+
+    def stats(self):
+        return {
+            'running': self.task is not None,
+            'interval': self.interval,
+            'threshold': self.threshold,
+            'samples': len(self.lags),
+            'lag': {f'{k:g}': v for k, v in self.percentiles().items()},
+            'blocked': list(self.reports),
+        }
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(threshold={self.threshold})'
+
+
+class DebugHandlers:
+    def __init__(self, profiler=None, monitor=None):
+        self.profiler = profiler or SamplingProfiler()
+        self.monitor = monitor
+
+    def conflict(self):
+        return aiohttp.web.HTTPConflict(reason='Profiler is already running')
+
+    async def profile(self, request):
+        try:
+            duration = float(request.query.get('seconds', '10'))
+        except ValueError:
+            raise aiohttp.web.HTTPBadRequest(reason='seconds must be a number')
+        if self.profiler.running:
+            raise self.conflict()
+        return self.profile_response(await self.profiler.profile(duration))
+
+    async def profile_start(self, request):
+        if self.profiler.running:
+            raise self.conflict()
+        self.profiler.start()
+        return aiohttp.web.json_response({'running': True, 'max_duration': self.profiler.max_duration}, status=202)
+
+    async def profile_stop(self, request):
+        if self.profiler.started is None:
+            raise aiohttp.web.HTTPConflict(reason='Profiler was not started')
+        return self.profile_response(await asyncio.get_event_loop().run_in_executor(None, self.profiler.stop))
+
+    def profile_response(self, collapsed):
+        return aiohttp.web.Response(
+            text=collapsed,
+            content_type='text/plain',
+            headers={'X-Profile-Samples': str(self.profiler.sample_count)},
+        )
+
+    async def loop(self, request):
+        lag = await loop_lag()
+        tasks = sorted(
+            (task_info(x) for x in asyncio.all_tasks()),
+            key=lambda x: (x['coroutine'], x['location'] or ''),
+        )
+        return aiohttp.web.json_response(
+            {
+                'lag': {'samples': lag, 'max': max(lag)},
+                'tasks': tasks,
+                'task_count': len(tasks),
+                **({'monitor': self.monitor.stats()} if self.monitor is not None else {}),
+            },
+            dumps=lambda x: json.dumps(x, default=str),
+        )
+
+    def routes(self):
+        return (
+            ('GET', '/debug/profile', self.profile),
+            ('POST', '/debug/profile/start', self.profile_start),
+            ('POST', '/debug/profile/stop', self.profile_stop),
+            ('GET', '/debug/loop', self.loop),
+        )
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.profiler})'
@@ -1,35 +1,175 @@
 import asyncio
+import collections
 import logging
+import struct
+import time
 
 import aiohttp.web
 
 
-async def handler(path, request):
-    logging.debug('New connection received')
-    try:
-        ws = aiohttp.web.WebSocketResponse()
-        reader, writer = await asyncio.open_unix_connection(path)
-        await ws.prepare(request)
-        await streamer(ws, reader, writer)
-        return ws
-    finally:
-        logging.debug('Connection closed')
+READ_SIZE = 64 * 1024
+FRAME_SIZE = 256 * 1024
+FLUSH_WINDOW = 0.005
+MAX_IN_FLIGHT = 1024 * 1024
+
+
+class ProxyStats:
+    def __init__(self):
+        self.started = self.touched = time.monotonic()
+        self.counters = collections.Counter()
+
+    def count(self, direction, size):
+        self.touched = time.monotonic()
+        self.counters[f'{direction}_bytes'] += size
+        self.counters[f'{direction}_frames'] += 1
+
+    @property
+    def throughput(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return {
+            direction: self.counters[f'{direction}_bytes'] / elapsed
+            for direction in ('tcp2ws', 'ws2tcp')
+        }
+
+    def __repr__(self):
+        counters = ' '.join(f'{k}={v}' for k, v in sorted(self.counters.items()))
+        return f'{self.__class__.__name__}({counters})'
+
+
+class DockerProxy:
+    MAX_CONNECTIONS = 16
+    MAX_STREAMS = 8
+    IDLE_TIMEOUT = 300
+    STREAM_HEADER = struct.Struct('!I')
+
+    def __init__(
+        self,
+        path,
+        max_connections=MAX_CONNECTIONS,
+        max_streams=MAX_STREAMS,
+        idle_timeout=IDLE_TIMEOUT,
+        max_in_flight=MAX_IN_FLIGHT,
+    ):
+        self.path = path
+        self.max_connections = max_connections
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+        self.max_in_flight = max_in_flight
+        self.connections = set()
+
+    async def connect(self):
+        reader, writer = await asyncio.open_unix_connection(self.path, limit=self.max_in_flight)
+        writer.transport.set_write_buffer_limits(high=self.max_in_flight)
+        return reader, writer
+
+    async def handler(self, request):
+        if len(self.connections) >= self.max_connections:
+            raise aiohttp.web.HTTPServiceUnavailable(reason='Too many proxied connections')
+        logging.debug('New connection received')
+        ws, stats = aiohttp.web.WebSocketResponse(), ProxyStats()
+        self.connections.add(ws)
+        watchdog = None
+        try:
+            if 'multiplex' in request.query:
+                await ws.prepare(request)
+                watchdog = asyncio.ensure_future(self.watchdog(ws, stats))
+                await self.multiplex(ws, stats)
+            else:
+                reader, writer = await self.connect()
+                await ws.prepare(request)
+                watchdog = asyncio.ensure_future(self.watchdog(ws, stats))
+                await streamer(ws, reader, writer, stats)
+            return ws
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            self.connections.discard(ws)
+            logging.debug(f'Connection closed {stats}')
+
+    async def watchdog(self, ws, stats):
+        while not ws.closed:
+            idle = time.monotonic() - stats.touched
+            if idle >= self.idle_timeout:
+                logging.debug('Closing idle connection')
+                await ws.close()
+                return
+            await asyncio.sleep(self.idle_timeout - idle)
+
+    async def multiplex(self, ws, stats):
+        streams, opened = {}, []
+        try:
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.BINARY or len(message.data) < self.STREAM_HEADER.size:
+                    raise RuntimeError(f'{message.type} not supported')
+                stream_id, = self.STREAM_HEADER.unpack_from(message.data)
+                payload = message.data[self.STREAM_HEADER.size:]
+                stats.count('ws2tcp', len(payload))
+                if stream_id not in streams:
+                    if not payload:
+                        continue
+                    if len(streams) >= self.max_streams:
+                        await ws.send_bytes(self.STREAM_HEADER.pack(stream_id))
+                        continue
+                    reader, writer = await self.connect()
+                    task = asyncio.ensure_future(self.stream(ws, stream_id, reader, stats))
+                    streams[stream_id] = (writer, task)
+                    opened.append((stream_id, writer, task))
+                    task.add_done_callback(lambda _, stream_id=stream_id: self.close_stream(streams, stream_id))
+                writer, _ = streams[stream_id]
+                if payload:
+                    writer.write(payload)
+                    await writer.drain()
+                else:
+                    self.close_stream(streams, stream_id)
+        finally:
+            for stream_id in list(streams):
+                self.close_stream(streams, stream_id)
+            results = await asyncio.gather(*(task for _, _, task in opened), return_exceptions=True)
+            for (stream_id, writer, _), result in zip(opened, results):
+                if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+                    logging.warning(f'Stream {stream_id} failed: {result!r}')
+                try:
+                    await writer.wait_closed()
+                except OSError as exc:
+                    logging.debug(f'Stream {stream_id} closed with {exc!r}')
+
+    async def stream(self, ws, stream_id, reader, stats):
+        header = self.STREAM_HEADER.pack(stream_id)
+        while True:
+            data = await read_frame(reader, frame_size=FRAME_SIZE - len(header))
+            if not ws.closed:
+                await ws.send_bytes(header + data)
+            if not data:
+                break
+            stats.count('tcp2ws', len(data))
+
+    @staticmethod
+    def close_stream(streams, stream_id):
+        if stream_id in streams:
+            writer, task = streams.pop(stream_id)
+            task.cancel()
+            writer.close()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}("{self.path}")'
 
 
 async def streamer(
     ws,
     reader: asyncio.StreamReader,
     writer: asyncio.StreamWriter,
+    stats=None,
 ):
+    stats = stats or ProxyStats()
     create_task = asyncio.get_event_loop().create_task
-    other = create_task(tcp2ws(ws, reader))
+    other = create_task(tcp2ws(ws, reader, stats))
 
     def ws_close(*args, **kwargs):
         create_task(ws.close())
     other.add_done_callback(ws_close)
 
     try:
-        await ws2tcp(ws, writer)
+        await ws2tcp(ws, writer, stats)
     finally:
         other.cancel()
         await other
@@ -38,11 +178,15 @@ async def streamer(
 async def ws2tcp(
     ws,
     writer: asyncio.StreamWriter,
+    stats=None,
 ):
     try:
         async for data in ws:
             if data.type == aiohttp.WSMsgType.BINARY:
                 writer.write(data.data)
+                if stats is not None:
+                    stats.count('ws2tcp', len(data.data))
+                await writer.drain()
             else:
                 raise RuntimeError(f'{data.type} not supported')
     finally:
@@ -51,12 +195,40 @@ async def ws2tcp(
         await writer.wait_closed()
 
 
+async def read_frame(
+    reader: asyncio.StreamReader,
+    read_size=READ_SIZE,
+    frame_size=FRAME_SIZE,
+    flush_window=FLUSH_WINDOW,
+):
+    data = await reader.read(read_size)
+    if not data:
+        return data
+    loop = asyncio.get_event_loop()
+    frame, deadline = bytearray(data), loop.time() + flush_window
+    while len(frame) < frame_size and not reader.at_eof():
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            data = await asyncio.wait_for(reader.read(min(read_size, frame_size - len(frame))), timeout)
+        except asyncio.TimeoutError:
+            break
+        if not data:
+            break
+        frame += data
+    return bytes(frame)
+
+
 async def tcp2ws(
     ws,
     reader: asyncio.StreamReader,
+    stats=None,
 ):
     while True:
-        data = await reader.read(1024)
+        data = await read_frame(reader)
         if not data:
             break
         await ws.send_bytes(data)
+        if stats is not None:
+            stats.count('tcp2ws', len(data))
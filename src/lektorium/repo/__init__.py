@@ -5,6 +5,13 @@ from .interface import (
     InvalidSessionState,
     SessionNotFound,
 )
-from .local import Repo as LocalRepo
 from .memory import SITES
 from .memory import Repo as ListRepo
+
+
+def __getattr__(name):
+    if name != 'LocalRepo':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    from .local import Repo as LocalRepo
+    globals()[name] = LocalRepo
+    return LocalRepo
@@ -1,8 +1,14 @@
 import abc
+import contextlib
 import random
 import string
 from typing import Generator, Iterable, Mapping, Optional, Tuple
 
+from cached_property import cached_property
+
+from ..events import EventBus
+from ..utils import KeyedLocks
+
 
 class ExceptionBase(Exception):
     pass
@@ -20,6 +26,16 @@ class SessionNotFound(ExceptionBase):
     pass
 
 
+def custodian_matches(item, custodian):
+    return custodian is None or custodian in (item.get('custodian', None), item.get('custodian_email', None))
+
+
+def session_matches(session, site, site_ids=None, custodian=None, parked=None):
+    site_matches = site_ids is None or site['site_id'] in site_ids
+    parked_matches = parked is None or parked == (not session.get('edit_url', None))
+    return site_matches and parked_matches and custodian_matches(session, custodian)
+
+
 class Repo(metaclass=abc.ABCMeta):
     DEFAULT_USER = ('User Interface Py', 'user@interface.py')
 
@@ -29,6 +45,36 @@ class Repo(metaclass=abc.ABCMeta):
             session_id = ''.join(random.sample(string.ascii_lowercase, 8))
         return session_id
 
+    @cached_property
+    def locks(self):
+        return KeyedLocks()
+
+    @cached_property
+    def events(self):
+        return EventBus()
+
+    def publish(self, event, site_id=None, session_id=None, **data):
+        self.events.publish(event, site_id=site_id, session_id=session_id, **data)
+
+    def find_sessions(self, site_ids=None, custodian=None, parked=None):
+        return [
+            session_id
+            for session_id, (session, site) in self.sessions.items()
+            if session_matches(session, site, site_ids, custodian, parked)
+        ]
+
+    def find_sites(self, custodian=None):
+        return [x['site_id'] for x in self.sites if custodian_matches(x, custodian)]
+
+    def jobs(self, site_id=None, session_id=None, limit=100, site_ids=None):
+        return []
+
+    @contextlib.asynccontextmanager
+    async def transition(self, site_id=None, session_id=None):
+        key = ('site', site_id) if session_id is None else ('session', session_id)
+        async with self.locks(key):
+            yield
+
     @property
     @abc.abstractmethod
     def sites(self) -> Iterable:
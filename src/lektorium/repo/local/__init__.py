@@ -1,5 +1,27 @@
 # flake8: noqa
-from .lektor import FakeLektor, LocalLektor
-from .repo import Repo
-from .server import AsyncDockerServer, AsyncDockerServerLectern, AsyncLocalServer, FakeServer
-from .storage import FileStorage, GitlabStorage, GitStorage
+import importlib
+
+
+MODULES = {
+    'FakeLektor': '.lektor',
+    'LocalLektor': '.lektor',
+    'Repo': '.repo',
+    'AsyncDockerServer': '.server',
+    'AsyncDockerServerLectern': '.server',
+    'AsyncLocalServer': '.server',
+    'FakeServer': '.server',
+    'FileStorage': '.storage',
+    'GitlabStorage': '.storage',
+    'GitStorage': '.storage',
+}
+
+
+def __getattr__(name):
+    if name not in MODULES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = globals()[name] = getattr(importlib.import_module(MODULES[name], __name__), name)
+    return value
+
+
+def __dir__():
+    return sorted({*globals(), *MODULES})
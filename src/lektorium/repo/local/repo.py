@@ -1,18 +1,22 @@
 import asyncio
 import collections.abc
+import contextlib
 import functools
 import pathlib
 import shutil
 import tempfile
 from datetime import datetime
+from types import MappingProxyType
 
 from cached_property import cached_property
 
-from ...utils import closer
+from ... import tracing
+from ...utils import closer, nothing
 from ..interface import DuplicateEditSession, InvalidSessionState
 from ..interface import Repo as BaseRepo
 from ..interface import SessionNotFound
 from .objects import Session, Site
+from .state import state_store
 
 
 class FilteredDict(collections.abc.Mapping):
@@ -52,7 +56,7 @@ class FilteredMergeRequestData(FilteredDict):
 
 
 class Repo(BaseRepo):
-    def __init__(self, storage, server, lektor, sessions_root=None):
+    def __init__(self, storage, server, lektor, sessions_root=None, state_path=None):
         self.storage = storage
         self.server = server
         self.lektor = lektor
@@ -60,9 +64,59 @@ class Repo(BaseRepo):
             sessions_root = closer(tempfile.TemporaryDirectory())
         self.sessions_root = pathlib.Path(sessions_root)
         self.sessions_initialized = False
-        self.init_sites()
+        self.session_index = {}
+        self.active_sessions = {}
+        self.snapshot = state_path and state_store(state_path)
+        self.snapshot_sessions = None
+        self.reconciling = None
+        if not self.load_snapshot():
+            self.init_sites()
+        if self.shared:
+            self.snapshot.sync_sites(self.config.values())
 
     def init_sites(self):
+        for site_id, sessions in self.scan_sessions().items():
+            for session in sessions.values():
+                self.register_session(self.config[site_id], session)
+
+    def register_session(self, site, session):
+        session_id, site_id = session['session_id'], site['site_id']
+        site.sessions[session_id] = session
+        self.session_index[session_id] = (session, site)
+        if not session.parked:
+            self.active_sessions[site_id] = session_id
+        elif self.active_sessions.get(site_id, None) == session_id:
+            self.active_sessions.pop(site_id)
+
+    def unregister_session(self, session_id):
+        session, site = self.session_index.pop(session_id)
+        site.sessions.pop(session_id, None)
+        if self.active_sessions.get(site['site_id'], None) == session_id:
+            self.active_sessions.pop(site['site_id'])
+        return session, site
+
+    def watch_start(self, site_id, session_id, session_dir):
+        self.publish('starting', site_id, session_id)
+        started = self.server.started(session_dir)
+        if started is None:
+            self.publish('ready', site_id, session_id, edit_url=self.session_index[session_id][0].edit_url)
+        else:
+            started.add_done_callback(functools.partial(self.server_started, site_id, session_id))
+
+    def server_started(self, site_id, session_id, started):
+        if started.cancelled() or session_id not in self.session_index:
+            return
+        if self.shared:
+            self.snapshot.update(site_id, self.session_index[session_id][0])
+        else:
+            self.save_snapshot(site_id)
+        if started.exception() is not None:
+            self.publish('failed', site_id, session_id)
+        else:
+            self.publish('ready', site_id, session_id, edit_url=started.result())
+
+    def scan_sessions(self):
+        result = {}
         for site_id, site in self.config.items():
             site_dir = self.sessions_root / site_id
             if site_dir.exists():
@@ -77,46 +131,171 @@ class Repo(BaseRepo):
                         preview_url=None,
                         legacy_admin_url=None,
                     )
-                    site.sessions[session['session_id']] = session
+                    result.setdefault(site_id, {})[session['session_id']] = session
+        return result
 
-    async def init_sessions(self):
-        if not self.sessions_initialized:
-            sessions = self.server.sessions
-            if asyncio.iscoroutine(sessions):
-                sessions = await sessions
-            for session in sessions:
-                session = dict(session)
-                site_id = session.pop('site_id', None)
-                if site_id is None or site_id not in self.config:
-                    continue
-                session = Session(session)
-                session_id = session['session_id']
-                self.config[site_id].sessions[session_id] = session
+    def load_snapshot(self):
+        state = self.snapshot and self.snapshot.load()
+        if state is None:
+            return False
+        self.snapshot_sessions = {}
+        for site_id, sessions in state.items():
+            if site_id not in self.config:
+                continue
+            for session_id, session in sessions.items():
+                self.register_session(self.config[site_id], Session(session))
+                self.snapshot_sessions[session_id] = session.get('edit_url', None)
+        return True
+
+    def save_snapshot(self, site_id=None):
+        if self.snapshot is None:
+            return
+        site_ids = self.config if site_id is None or not self.shared else (site_id,)
+        self.snapshot.save({x: self.config[x].sessions for x in site_ids})
+
+    @property
+    def shared(self):
+        return bool(self.snapshot and self.snapshot.shared)
+
+    def refresh(self):
+        changes = self.snapshot.changes() if self.shared else ()
+        if not changes:
+            return False
+        if 'sites' in changes:
+            self.storage.__dict__.pop('config', None)
+            self.__dict__.pop('config', None)
+        state = self.snapshot.load() or {}
+        previous, self.session_index, self.active_sessions = self.session_index, {}, {}
+        for site_id, site in self.config.items():
+            site.sessions.clear()
+            for session_id, data in state.get(site_id, {}).items():
+                session = Session(data)
+                current = previous.get(session_id, (None, None))[0]
+                if current is not None and callable(current.data.get('edit_url')) and not session.parked:
+                    session = current
+                self.register_session(site, session)
+        self.publish('refreshed')
+        return True
+
+    def publish(self, event, site_id=None, session_id=None, **data):
+        super().publish(event, site_id, session_id, **data)
+        if self.shared and event != 'refreshed':
+            self.snapshot.record(event, site_id, session_id, **data)
+
+    def find_sessions(self, site_ids=None, custodian=None, parked=None):
+        if not self.shared:
+            return super().find_sessions(site_ids, custodian, parked)
+        self.refresh()
+        return [x for x in self.snapshot.find_sessions(site_ids, custodian, parked) if x in self.session_index]
+
+    def find_sites(self, custodian=None):
+        if not self.shared:
+            return super().find_sites(custodian)
+        self.refresh()
+        return [x for x in self.snapshot.find_sites(custodian) if x in self.config]
+
+    def jobs(self, site_id=None, session_id=None, limit=100, site_ids=None):
+        return self.snapshot.jobs(site_id, session_id, limit, site_ids) if self.shared else []
+
+    async def watch_state(self, interval=1):
+        while True:
+            self.refresh()
+            await asyncio.sleep(interval)
+
+    def state_lock(self, site_id=None):
+        return self.snapshot.lock(site_id) if self.shared else nothing()
+
+    @contextlib.asynccontextmanager
+    async def transition(self, site_id=None, session_id=None):
+        if site_id is None and session_id in self.sessions:
+            site_id = self.session_index[session_id][1]['site_id']
+        async with super().transition(site_id=site_id, session_id=session_id):
+            async with self.state_lock(site_id):
+                self.refresh()
+                yield
+
+    async def server_sessions(self):
+        sessions = self.server.sessions
+        if asyncio.iscoroutine(sessions):
+            sessions = await sessions
+        return sessions
+
+    def apply_server_sessions(self, sessions):
+        for session in sessions:
+            session = dict(session)
+            site_id = session.pop('site_id', None)
+            if site_id is None or site_id not in self.config:
+                continue
+            self.register_session(self.config[site_id], Session(session))
+
+    def start_reconcile(self):
+        if self.snapshot_sessions is not None and self.reconciling is None:
+            self.reconciling = asyncio.ensure_future(self.reconcile())
             self.sessions_initialized = True
 
+    async def init_sessions(self):
+        if self.sessions_initialized:
+            return
+        if self.snapshot_sessions is not None:
+            self.start_reconcile()
+        else:
+            self.apply_server_sessions(await self.server_sessions())
+        self.sessions_initialized = True
+
+    async def reconcile(self):
+        loaded, self.snapshot_sessions = self.snapshot_sessions, None
+        on_disk = await tracing.run_in_executor(self.scan_sessions)
+        try:
+            running = list(await self.server_sessions())
+        except RuntimeError:
+            running = []
+        for site_id in list(self.config):
+            async with self.transition(site_id=site_id):
+                if site_id in self.config:
+                    self.reconcile_site(self.config[site_id], loaded, on_disk.get(site_id, {}), running)
+                    self.save_snapshot(site_id)
+
+    def reconcile_site(self, site, loaded, site_disk, running):
+        site_id = site['site_id']
+        running = [x for x in running if x.get('site_id', None) == site_id]
+        running_ids = {x['session_id'] for x in running}
+        for session_id in set(loaded).intersection(site.sessions):
+            session = site.sessions[session_id]
+            if session.data.get('edit_url', None) != loaded[session_id]:
+                continue
+            if session_id not in site_disk:
+                self.unregister_session(session_id)
+            elif session_id not in running_ids and not session.parked:
+                session['edit_url'] = None
+                session['preview_url'] = None
+                session['legacy_admin_url'] = None
+                session['parked_time'] = site_disk[session_id]['parked_time']
+                self.register_session(site, session)
+        for session_id, session in site_disk.items():
+            if session_id not in self.session_index:
+                self.register_session(site, session)
+        self.apply_server_sessions(running)
+
     @cached_property
     def config(self):
         return self.storage.config
 
     @property
     def sites(self):
+        self.refresh()
         yield from self.config.values()
 
     @property
     def sessions(self):
-        def iterate():
-            for site in self.config.values():
-                for session_id, session in site.sessions.items():
-                    yield session_id, (session, site)
-
-        return dict(iterate())
+        self.refresh()
+        return MappingProxyType(self.session_index)
 
     @property
     def parked_sessions(self):
-        for site in self.config.values():
-            for session in site.sessions.values():
-                if session.parked:
-                    yield session
+        self.refresh()
+        for session_id, (session, site) in self.session_index.items():
+            if self.active_sessions.get(site['site_id'], None) != session_id:
+                yield session
 
     @property
     def releasing(self):
@@ -135,7 +314,7 @@ class Repo(BaseRepo):
     def create_session(self, site_id, themes=None, custodian=None):
         custodian, custodian_email = custodian or self.DEFAULT_USER
         site = self.config[site_id]
-        if any(not s.parked for s in site.sessions.values()):
+        if site_id in self.active_sessions:
             raise DuplicateEditSession()
         session_id = self.generate_session_id()
         session_dir = self.sessions_root / site_id / session_id
@@ -155,24 +334,29 @@ class Repo(BaseRepo):
                 'site_id': site_id,
             },
         )
-        site.sessions[session_id] = session_object
+        self.register_session(site, session_object)
+        self.save_snapshot(site_id)
+        self.watch_start(site_id, session_id, session_dir)
         return session_id
 
-    def destroy_session(self, session_id):
-        if session_id not in self.sessions:
+    def destroy_session(self, session_id, release=False):
+        if session_id not in self.session_index:
             raise SessionNotFound()
-        site = self.sessions[session_id][1]
+        site = self.session_index[session_id][1]
         session_dir = self.sessions_root / site['site_id'] / session_id
         self.server.stop_server(
             session_dir,
             functools.partial(shutil.rmtree, session_dir),
         )
-        site.sessions.pop(session_id)
+        self.server.drop_build_cache(session_dir, site['site_id'] if release else None)
+        self.unregister_session(session_id)
+        self.save_snapshot(site['site_id'])
+        self.publish('destroyed', site['site_id'], session_id)
 
     def park_session(self, session_id):
-        if session_id not in self.sessions:
+        if session_id not in self.session_index:
             raise SessionNotFound()
-        session, site = self.sessions[session_id]
+        session, site = self.session_index[session_id]
         site_id = site['site_id']
         session_dir = self.sessions_root / site_id / session_id
         if session.parked:
@@ -183,16 +367,19 @@ class Repo(BaseRepo):
         session['preview_url'] = None
         session['legacy_admin_url'] = None
         session['parked_time'] = datetime.now()
+        self.active_sessions.pop(site_id, None)
+        self.save_snapshot(site_id)
+        self.publish('parked', site_id, session_id)
 
     def unpark_session(self, session_id):
-        if session_id not in self.sessions:
+        if session_id not in self.session_index:
             raise SessionNotFound()
-        session, site = self.sessions[session_id]
+        session, site = self.session_index[session_id]
         if not session.parked:
             raise InvalidSessionState()
-        if any(not s.parked for s in site.sessions.values()):
-            raise DuplicateEditSession()
         site_id = site['site_id']
+        if site_id in self.active_sessions:
+            raise DuplicateEditSession()
         session_dir = self.sessions_root / site_id / session_id
         self.storage.update_session(site_id, session_id, session_dir)
         session['edit_url'] = self.server.serve_lektor(
@@ -200,6 +387,9 @@ class Repo(BaseRepo):
             {**session, 'site_id': site_id},
         )
         session.pop('parked_time', None)
+        self.active_sessions[site_id] = session_id
+        self.save_snapshot(site_id)
+        self.watch_start(site_id, session_id, session_dir)
 
     async def create_site(self, site_id, name, themes=None, owner=None):
         owner, email = owner or self.DEFAULT_USER
@@ -227,17 +417,22 @@ class Repo(BaseRepo):
                 **site_options,
             ),
         )
+        if self.shared:
+            self.snapshot.sites_changed(self.config[site_id])
+        self.publish('site-created', site_id)
 
     def request_release(self, session_id):
-        if session_id not in self.sessions:
+        if session_id not in self.session_index:
             raise SessionNotFound()
-        session, site = self.sessions[session_id]
+        session, site = self.session_index[session_id]
         if session.parked:
             raise InvalidSessionState()
         site_id = site['site_id']
         session_dir = self.sessions_root / site_id / session_id
+        self.publish('releasing', site_id, session_id)
         self.storage.request_release(site_id, session_id, session_dir)
-        self.destroy_session(session_id)
+        self.destroy_session(session_id, release=True)
+        self.publish('released', site_id, session_id)
 
     def __repr__(self):
         qname = f'{self.__class__.__module__}.{self.__class__.__name__}'
@@ -1,22 +1,43 @@
 import abc
 import asyncio
+import collections
+import contextlib
+import errno
 import functools
+import itertools
+import json
 import logging
 import os
 import pathlib
 import random
+import shlex
+import shutil
 import subprocess
+import sys
+import tempfile
+import time
 from datetime import datetime
 from types import MappingProxyType
 
-import aiodocker
 from more_itertools import one
-from spherical.dev.utils import flatten_options
+
+from ... import metrics, tracing
+from ...utils import lazy_import
+
+
+aiodocker = lazy_import('aiodocker')
+spherical_utils = lazy_import('spherical.dev.utils')
 
 
 EMPTY_DICT = MappingProxyType({})
 
 
+@contextlib.contextmanager
+def docker_call(operation, **attributes):
+    with tracing.span(f'docker.{operation}', **attributes), metrics.DOCKER_SECONDS.time(operation=operation):
+        yield
+
+
 class Server(metaclass=abc.ABCMeta):
     START_PORT = 5000
     END_PORT = 6000
@@ -46,6 +67,12 @@ class Server(metaclass=abc.ABCMeta):
     def stop_server(self, path, finalizer=None):
         pass
 
+    def started(self, path):
+        return None
+
+    def drop_build_cache(self, path, site_id=None):
+        pass
+
     def __repr__(self):
         return f'{self.__class__.__name__}()'
 
@@ -68,11 +95,94 @@ class FakeServer(Server):
     serve_static = serve_lektor
 
 
+class BuildCache:
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+
+    def site_snapshot(self, site_id):
+        return self.root / 'sites' / site_id
+
+    def output_path(self, path):
+        return self.root / 'sessions' / pathlib.Path(path).name
+
+    def seed(self, path, site_id):
+        output = self.output_path(path)
+        if site_id and not output.exists() and self.site_snapshot(site_id).exists():
+            output.parent.mkdir(parents=True, exist_ok=True)
+            self.copy(self.site_snapshot(site_id), output)
+        return output
+
+    def refresh(self, path, site_id):
+        output, snapshot = self.output_path(path), self.site_snapshot(site_id)
+        if not output.exists():
+            return
+        snapshot.parent.mkdir(parents=True, exist_ok=True)
+        work = pathlib.Path(tempfile.mkdtemp(prefix=f'.{snapshot.name}.', dir=snapshot.parent))
+        staging = work / 'staging'
+        try:
+            self.copy(output, staging)
+            for attempt in itertools.count():
+                with contextlib.suppress(FileNotFoundError):
+                    snapshot.rename(work / f'previous.{attempt}')
+                try:
+                    staging.rename(snapshot)
+                    return
+                except OSError as error:
+                    if error.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                        raise
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+    def drop(self, path):
+        shutil.rmtree(self.output_path(path), ignore_errors=True)
+
+    @staticmethod
+    def copy(source, target):
+        try:
+            subprocess.check_call(
+                ['cp', '-a', '--reflink=auto', str(source), str(target)],
+                stderr=subprocess.DEVNULL,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            shutil.rmtree(target, ignore_errors=True)
+            shutil.copytree(source, target, symlinks=True)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}("{self.root}")'
+
+
 class AsyncServer(Server):
     LOGGER = logging.getLogger()
 
-    def __init__(self):
+    def __init__(self, *, build_cache=None):
         self.serves = {}
+        self.stopping = {}
+        self.build_cache = build_cache and BuildCache(build_cache)
+
+    async def seed_build_cache(self, path, session):
+        if self.build_cache is None:
+            return None
+        return await tracing.run_in_executor(
+            self.build_cache.seed,
+            path,
+            session.get('site_id', None),
+        )
+
+    def started(self, path):
+        return self.serves.get(path, (None, None))[1]
+
+    def drop_build_cache(self, path, site_id=None):
+        if self.build_cache is not None:
+            result = asyncio.ensure_future(self.release_build_cache(path, site_id))
+            result.add_done_callback(lambda _: result.result())
+
+    async def release_build_cache(self, path, site_id=None):
+        stopping = self.stopping.get(path, None)
+        if stopping is not None:
+            await asyncio.wait([stopping])
+        if site_id is not None:
+            await tracing.run_in_executor(self.build_cache.refresh, path, site_id)
+        await tracing.run_in_executor(self.build_cache.drop, path)
 
     def serve_lektor(self, path, session=EMPTY_DICT):
         def resolver(started):
@@ -87,15 +197,33 @@ class AsyncServer(Server):
             return (functools.partial(resolver, started), 'Starting')
 
         started = asyncio.Future()
-        task = asyncio.ensure_future(self.start(path, started, dict(session)))
+        started.add_done_callback(functools.partial(self.observe_start, time.perf_counter()))
+        task = asyncio.ensure_future(self.traced_start(path, started, dict(session)))
         self.serves[path] = [lambda: task if task.cancel() else task, started]
         return functools.partial(resolver, started)
 
     serve_static = serve_lektor
 
+    def observe_start(self, requested, started):
+        if started.cancelled():
+            result = 'cancelled'
+        else:
+            result = 'ok' if started.exception() is None else 'error'
+        metrics.SESSION_START_SECONDS.observe(
+            time.perf_counter() - requested,
+            server=self.__class__.__name__,
+            result=result,
+        )
+
     def stop_server(self, path, finalizer=None):
         result = asyncio.ensure_future(self.stop(path, finalizer))
+        self.stopping[path] = result
         result.add_done_callback(lambda _: result.result())
+        result.add_done_callback(lambda _: self.stopping.get(path, None) is result and self.stopping.pop(path))
+
+    async def traced_start(self, path, started, session):
+        with tracing.span('server.start', server=self.__class__.__name__, session_id=session.get('session_id', None)):
+            await self.start(path, started, session)
 
     @abc.abstractmethod
     async def start(self, path, started, session):
@@ -110,21 +238,100 @@ class AsyncServer(Server):
         await finalize
 
 
+class LektorWorkerPool:
+    SCRIPT = '''
+import json, os, sys
+from lektor.cli import cli
+line = sys.stdin.readline()
+if not line:
+    sys.exit(0)
+request = json.loads(line)
+os.chdir(request['path'])
+cli.main(request['args'], prog_name='lektor')
+'''
+
+    def __init__(self, size, script=None):
+        self.size = int(size)
+        self.script = script or self.SCRIPT
+        self.idle = collections.deque()
+        self.spawning = set()
+
+    async def spawn(self):
+        return await asyncio.create_subprocess_exec(
+            sys.executable,
+            '-u',
+            '-c',
+            self.script,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+
+    def fill(self):
+        for _ in range(self.size - len(self.idle) - len(self.spawning)):
+            task = asyncio.ensure_future(self.spawn())
+            self.spawning.add(task)
+            task.add_done_callback(self.spawned)
+
+    def spawned(self, task):
+        self.spawning.discard(task)
+        if not task.cancelled() and task.exception() is None:
+            self.idle.append(task.result())
+
+    async def acquire(self, path, args):
+        proc = None
+        while self.idle and proc is None:
+            proc = self.idle.popleft()
+            if proc.returncode is not None:
+                proc = None
+        if proc is None:
+            proc = await self.spawn()
+        self.fill()
+        request = json.dumps({'path': str(path), 'args': args})
+        proc.stdin.write(f'{request}\n'.encode())
+        await proc.stdin.drain()
+        proc.stdin.close()
+        return proc
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.size})'
+
+
 class AsyncLocalServer(AsyncServer):
     COMMAND = 'lektor server -h 0.0.0.0 -p {port}'
 
+    def __init__(self, *, build_cache=None, pool_size=0):
+        super().__init__(build_cache=build_cache)
+        self.pool = LektorWorkerPool(pool_size) if int(pool_size) else None
+
+    def warm_up(self):
+        if self.pool is not None:
+            self.pool.fill()
+
+    async def spawn(self, path, port, output_path):
+        if self.pool is not None:
+            args = ['server', '-h', '0.0.0.0', '-p', f'{port}']
+            if output_path is not None:
+                args.extend(('-O', f'{output_path}'))
+            return await self.pool.acquire(path, args)
+        command = self.COMMAND.format(port=port)
+        if output_path is not None:
+            command = f'{command} -O {shlex.quote(str(output_path))}'
+        return await asyncio.create_subprocess_shell(
+            command,
+            cwd=path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+
     async def start(self, path, started, session):
         log = logging.getLogger(f'Server({path})')
         log.info('starting')
         try:
             try:
                 port = self.generate_port(())
-                proc = await asyncio.create_subprocess_shell(
-                    self.COMMAND.format(port=port),
-                    cwd=path,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                )
+                output_path = await self.seed_build_cache(path, session)
+                proc = await self.spawn(path, port, output_path)
                 async for line in proc.stdout:
                     if line.strip().startswith(b'Finished prune'):
                         break
@@ -158,8 +365,9 @@ class AsyncDockerServer(AsyncServer):
         lektor_image='lektorium-lektor',
         network=None,
         server_container='lektorium',
+        build_cache=None,
     ):
-        super().__init__()
+        super().__init__(build_cache=build_cache)
         if not pathlib.Path('/var/run/docker.sock').exists():
             raise RuntimeError('/var/run/docker.sock not exists')
         self.auto_remove = auto_remove
@@ -186,8 +394,9 @@ class AsyncDockerServer(AsyncServer):
                 yield session
 
         docker = aiodocker.Docker()
-        containers = (await c.show() for c in await docker.containers.list())
-        return list(parse([x async for x in containers]))
+        with docker_call('list'):
+            containers = [await c.show() for c in await docker.containers.list()]
+        return list(parse(containers))
 
     @property
     async def network_mode(self):
@@ -211,26 +420,32 @@ class AsyncDockerServer(AsyncServer):
             try:
                 session_id = pathlib.Path(path).name
                 container_name = f'{self.lektor_image}-{session_id}'
-                labels = flatten_options(self.lektor_labels(session_id), 'traefik')
+                labels = spherical_utils.flatten_options(self.lektor_labels(session_id), 'traefik')
                 session = self.update_session_params(session_id, container_name, session)
-                labels.update(flatten_options(session, self.LABEL_PREFIX))
+                labels.update(spherical_utils.flatten_options(session, self.LABEL_PREFIX))
+                command = ['--project', f'{path}', 'server', '--host', '0.0.0.0']
+                output_path = await self.seed_build_cache(path, session)
+                if output_path is not None:
+                    command.extend(('--output-path', f'{output_path}'))
                 docker = aiodocker.Docker()
-                container = await docker.containers.run(
-                    name=container_name,
-                    config=dict(
-                        HostConfig=dict(
-                            AutoRemove=self.auto_remove,
-                            NetworkMode=await self.network_mode,
-                            VolumesFrom=[
-                                self.server_container,
-                            ],
+                network_mode = await self.network_mode
+                with docker_call('run', container=container_name):
+                    container = await docker.containers.run(
+                        name=container_name,
+                        config=dict(
+                            HostConfig=dict(
+                                AutoRemove=self.auto_remove,
+                                NetworkMode=network_mode,
+                                VolumesFrom=[
+                                    self.server_container,
+                                ],
+                            ),
+                            Cmd=command,
+                            Env=self.env_vars(session),
+                            Labels=labels,
+                            Image=self.lektor_image,
                         ),
-                        Cmd=['--project', f'{path}', 'server', '--host', '0.0.0.0'],
-                        Env=self.env_vars(session),
-                        Labels=labels,
-                        Image=self.lektor_image,
-                    ),
-                )
+                    )
                 stream = container.log(stdout=True, stderr=True, follow=True)
                 async for line in stream:
                     logging.debug(line.strip())
@@ -264,10 +479,12 @@ class AsyncDockerServer(AsyncServer):
             return await super().stop(path, finalizer)
         session_id = path.name
         container_name = f'{self.lektor_image}-{session_id}'
-        for container in await aiodocker.Docker().containers.list():
-            info = await container.show()
+        with docker_call('list'):
+            containers = [(x, await x.show()) for x in await aiodocker.Docker().containers.list()]
+        for container, info in containers:
             if info['Name'] == f'/{container_name}':
-                await container.kill()
+                with docker_call('kill', container=container_name):
+                    await container.kill()
         callable(finalizer) and finalizer()
 
     def update_session_params(self, session_id, container_name, session):
@@ -0,0 +1,68 @@
+import json
+import os
+import pathlib
+from datetime import datetime
+
+
+class StateSnapshot:
+    VERSION = 1
+    TIME_KEYS = ('creation_time', 'parked_time')
+    PLAIN_TYPES = (str, int, float, bool, type(None))
+    shared = False
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+
+    def load(self):
+        try:
+            with self.path.open() as snapshot_file:
+                data = json.load(snapshot_file)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            return None
+        return {
+            site_id: {session_id: self.decode(session) for session_id, session in sessions.items()}
+            for site_id, sessions in data.get('sites', {}).items()
+        }
+
+    def save(self, sites):
+        data = {
+            'version': self.VERSION,
+            'saved': datetime.now().timestamp(),
+            'sites': {
+                site_id: {session_id: self.encode(session) for session_id, session in sessions.items()}
+                for site_id, sessions in sites.items()
+            },
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_name(f'.{self.path.name}.{os.getpid()}')
+        with temporary.open('w') as snapshot_file:
+            json.dump(data, snapshot_file)
+        os.replace(temporary, self.path)
+
+    @classmethod
+    def encode(cls, session):
+        # Reading edit_url runs the server resolver, which stores the URLs
+        # of a started server in the session. A server that is still
+        # starting keeps its resolver and is saved with the 'Starting'
+        # placeholder, so the session stays active rather than parked.
+        edit_url = session['edit_url'] if 'edit_url' in session else None
+        result = {}
+        for key, value in session.data.items():
+            if key == 'edit_url' and callable(value):
+                value = edit_url
+            if key in cls.TIME_KEYS and isinstance(value, datetime):
+                value = value.timestamp()
+            result[key] = value if isinstance(value, cls.PLAIN_TYPES) else None
+        return result
+
+    @classmethod
+    def decode(cls, session):
+        return {
+            key: (datetime.fromtimestamp(value) if key in cls.TIME_KEYS and value is not None else value)
+            for key, value in session.items()
+        }
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}("{self.path}")'
@@ -0,0 +1,280 @@
+import asyncio
+import contextlib
+import fcntl
+import json
+import pathlib
+import sqlite3
+import urllib.parse
+from datetime import datetime
+
+from .snapshot import StateSnapshot
+
+
+class SqliteState(StateSnapshot):
+    SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+    BUSY_TIMEOUT = 30
+    LOCK_POLL = 0.02
+    JOBS_LIMIT = 10000
+    MIGRATIONS = (
+        (
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value NUMERIC NOT NULL)',
+            """CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                site_id TEXT NOT NULL,
+                data TEXT NOT NULL
+            )""",
+        ),
+        (
+            'ALTER TABLE sessions ADD COLUMN custodian TEXT',
+            'ALTER TABLE sessions ADD COLUMN custodian_email TEXT',
+            'ALTER TABLE sessions ADD COLUMN creation_time REAL',
+            'ALTER TABLE sessions ADD COLUMN parked_time REAL',
+            'ALTER TABLE sessions ADD COLUMN parked INTEGER NOT NULL DEFAULT 0',
+            """UPDATE sessions SET
+                custodian = json_extract(data, '$.custodian'),
+                custodian_email = json_extract(data, '$.custodian_email'),
+                creation_time = json_extract(data, '$.creation_time'),
+                parked_time = json_extract(data, '$.parked_time'),
+                parked = coalesce(json_extract(data, '$.edit_url'), '') = ''""",
+            'CREATE INDEX sessions_site ON sessions (site_id, parked)',
+            'CREATE INDEX sessions_custodian ON sessions (custodian)',
+            'CREATE INDEX sessions_custodian_email ON sessions (custodian_email)',
+            """CREATE TABLE sites (
+                site_id TEXT PRIMARY KEY,
+                name TEXT,
+                owner TEXT,
+                email TEXT,
+                creation_time REAL
+            )""",
+            'CREATE INDEX sites_owner ON sites (owner)',
+            'CREATE INDEX sites_email ON sites (email)',
+            """CREATE TABLE jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                time REAL NOT NULL,
+                event TEXT NOT NULL,
+                site_id TEXT,
+                session_id TEXT,
+                data TEXT NOT NULL
+            )""",
+            'CREATE INDEX jobs_site ON jobs (site_id, time)',
+            'CREATE INDEX jobs_session ON jobs (session_id, time)',
+        ),
+    )
+    SESSION_COLUMNS = ('custodian', 'custodian_email', 'creation_time', 'parked_time')
+    shared = True
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.lock_path = self.path.with_name(f'{self.path.name}.lock')
+        self.locks_root = self.path.with_name(f'{self.path.name}.locks')
+        self.connection = None
+        self.seen_revision = None
+        self.seen = {}
+
+    def connect(self):
+        if self.connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(str(self.path), timeout=self.BUSY_TIMEOUT, isolation_level=None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.migrate()
+            self.changes()
+        return self.connection
+
+    def migrate(self):
+        with self.transaction() as connection:
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            for version, statements in enumerate(self.MIGRATIONS[version:], version + 1):
+                for statement in statements:
+                    connection.execute(statement)
+                connection.execute(f'PRAGMA user_version = {version:d}')
+
+    @property
+    def revision(self):
+        return self.connect().execute('PRAGMA data_version').fetchone()[0]
+
+    def meta(self, key):
+        row = self.connect().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row and row[0]
+
+    def changes(self):
+        revision = self.revision
+        if revision == self.seen_revision:
+            return set()
+        self.seen_revision = revision
+        current = dict(self.connection.execute("SELECT key, value FROM meta WHERE key IN ('sites', 'sessions')"))
+        changed = {x for x in current if current[x] != self.seen.get(x, None)}
+        self.seen.update(current)
+        return changed
+
+    def bump(self, connection, key):
+        row = connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        value = row[0] + 1 if row else 1
+        connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+        if self.seen.get(key, None) == (row and row[0]):
+            self.seen[key] = value
+
+    def load(self):
+        if self.meta('saved') is None:
+            return None
+        rows = self.connect().execute('SELECT site_id, session_id, data FROM sessions').fetchall()
+        result = {}
+        for site_id, session_id, data in rows:
+            result.setdefault(site_id, {})[session_id] = self.decode(json.loads(data))
+        return result
+
+    def session_row(self, site_id, session):
+        data = self.encode(session)
+        return (
+            site_id,
+            json.dumps(data),
+            *(data.get(x, None) for x in self.SESSION_COLUMNS),
+            int(not data.get('edit_url', None)),
+            data['session_id'],
+        )
+
+    def save(self, sites):
+        rows = [self.session_row(site_id, x) for site_id, sessions in sites.items() for x in sessions.values()]
+        with self.transaction() as connection:
+            connection.executemany('DELETE FROM sessions WHERE site_id = ?', [(x,) for x in sites])
+            connection.executemany(
+                """INSERT INTO sessions (site_id, data, custodian, custodian_email, creation_time, parked_time, parked,
+                    session_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                rows,
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('saved', ?)",
+                (datetime.now().timestamp(),),
+            )
+            self.bump(connection, 'sessions')
+
+    def update(self, site_id, session):
+        with self.transaction() as connection:
+            connection.execute(
+                """UPDATE sessions SET site_id = ?, data = ?, custodian = ?, custodian_email = ?, creation_time = ?,
+                    parked_time = ?, parked = ? WHERE session_id = ?""",
+                self.session_row(site_id, session),
+            )
+            self.bump(connection, 'sessions')
+
+    @staticmethod
+    def site_row(site, creation_time):
+        return (
+            site['site_id'],
+            site.get('name', None),
+            site.get('owner', None),
+            site.get('email', None),
+            creation_time,
+        )
+
+    def sites_changed(self, site=None):
+        with self.transaction() as connection:
+            if site is not None:
+                connection.execute(
+                    'INSERT OR REPLACE INTO sites (site_id, name, owner, email, creation_time) VALUES (?, ?, ?, ?, ?)',
+                    self.site_row(site, datetime.now().timestamp()),
+                )
+            self.bump(connection, 'sites')
+
+    def sync_sites(self, sites):
+        with self.transaction() as connection:
+            connection.executemany(
+                """INSERT INTO sites (site_id, name, owner, email, creation_time) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (site_id) DO UPDATE SET name = excluded.name, owner = excluded.owner,
+                    email = excluded.email""",
+                [self.site_row(x, None) for x in sites],
+            )
+
+    def find_sessions(self, site_ids=None, custodian=None, parked=None):
+        conditions, parameters = [], []
+        if site_ids is not None:
+            site_ids = list(site_ids)
+            conditions.append(f'site_id IN ({", ".join("?" * len(site_ids))})')
+            parameters.extend(site_ids)
+        if custodian is not None:
+            conditions.append('(custodian = ? OR custodian_email = ?)')
+            parameters.extend((custodian, custodian))
+        if parked is not None:
+            conditions.append('parked = ?')
+            parameters.append(int(parked))
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        query = f'SELECT session_id FROM sessions{where} ORDER BY site_id, creation_time, session_id'
+        return [x for x, in self.connect().execute(query, parameters)]
+
+    def find_sites(self, custodian=None):
+        query, parameters = 'SELECT site_id FROM sites', ()
+        if custodian is not None:
+            query, parameters = f'{query} WHERE owner = ? OR email = ?', (custodian, custodian)
+        return [x for x, in self.connect().execute(query, parameters)]
+
+    def record(self, event, site_id=None, session_id=None, **data):
+        data = {k: v for k, v in data.items() if isinstance(v, self.PLAIN_TYPES)}
+        with self.transaction() as connection:
+            connection.execute(
+                'INSERT INTO jobs (time, event, site_id, session_id, data) VALUES (?, ?, ?, ?, ?)',
+                (datetime.now().timestamp(), event, site_id, session_id, json.dumps(data)),
+            )
+            connection.execute('DELETE FROM jobs WHERE id <= last_insert_rowid() - ?', (self.JOBS_LIMIT,))
+
+    def jobs(self, site_id=None, session_id=None, limit=100, site_ids=None):
+        conditions, parameters = [], []
+        for column, value in (('site_id', site_id), ('session_id', session_id)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                parameters.append(value)
+        if site_ids is not None:
+            site_ids = list(site_ids)
+            conditions.append(f'site_id IN ({", ".join("?" * len(site_ids))})')
+            parameters.extend(site_ids)
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        rows = self.connect().execute(
+            f'SELECT time, event, site_id, session_id, data FROM jobs{where} ORDER BY time DESC, id DESC LIMIT ?',
+            (*parameters, limit),
+        )
+        return [
+            dict(json.loads(data), time=datetime.fromtimestamp(time), event=event, site_id=site, session_id=session)
+            for time, event, site, session, data in rows
+        ]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def lock_file(self, key=None):
+        if key is None:
+            return self.lock_path
+        return self.locks_root / urllib.parse.quote(key, safe='')
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key=None):
+        path = self.lock_file(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open('a') as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(self.LOCK_POLL)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def state_store(path):
+    if pathlib.Path(path).suffix in SqliteState.SUFFIXES:
+        return SqliteState(path)
+    return StateSnapshot(path)
@@ -1,6 +1,7 @@
 import abc
 import asyncio
 import collections
+import contextlib
 import functools
 import os
 import pathlib
@@ -11,14 +12,13 @@ from urllib.parse import quote_plus
 
 import dateutil
 import inifile
-import requests
-import unsync
 import yaml
 from cached_property import cached_property
 from more_itertools import one, only
 
+from ... import metrics, tracing
 from ...aws import AWS
-from ...utils import closer
+from ...utils import closer, lazy_import
 from .objects import Site
 from .templates import (
     AWS_SHARED_CREDENTIALS_FILE_TEMPLATE,
@@ -28,6 +28,10 @@ from .templates import (
 )
 
 
+requests = lazy_import('requests')
+unsync = lazy_import('unsync')
+
+
 LFS_MASKS = (
     '*.doc*',
     '*.xls*',
@@ -45,15 +49,31 @@ LFS_MASKS = (
     '*.ttf',
     '*.woff',
 )
-run = functools.partial(subprocess.check_call, shell=True)
-run_out = functools.partial(subprocess.check_output, shell=True)
+
+
+def command_name(command):
+    return ' '.join(command.split()[:2])
+
+
+@contextlib.contextmanager
+def command_call(command, cwd=None):
+    name = command_name(command)
+    with tracing.span('command', command=name, cwd=cwd and str(cwd)), metrics.COMMAND_SECONDS.time(command=name):
+        yield
+
+
+def run(command, **kwargs):
+    with command_call(command, kwargs.get('cwd', None)):
+        return subprocess.check_call(command, shell=True, **kwargs)
+
+
+def run_out(command, **kwargs):
+    with command_call(command, kwargs.get('cwd', None)):
+        return subprocess.check_output(command, shell=True, **kwargs)
 
 
 def async_run(func, *args, **kwargs):
-    return asyncio.get_event_loop().run_in_executor(
-        None,
-        functools.partial(func, *args, **kwargs),
-    )
+    return tracing.run_in_executor(func, *args, **kwargs)
 
 
 class ConfigGetter:
@@ -371,7 +391,7 @@ class GitLab:
         return '{namespace}/{project}'.format(**self.options)
 
     def lookup_parent_id(self, objects_type, path_attribute):
-        response = requests.get(
+        response = self.session.get(
             f'{self.repo_url}/{objects_type}',
             headers=self.headers,
         )
@@ -407,7 +427,7 @@ class GitLab:
         return ssh_repo_url
 
     def _create_new_project(self):
-        response = requests.post(
+        response = self.session.post(
             '{repo_url}/projects'.format(repo_url=self.repo_url),
             params={
                 'name': self.options['project'],
@@ -424,7 +444,7 @@ class GitLab:
         return response
 
     def _create_aws_project_variable(self):
-        response = requests.post(
+        response = self.session.post(
             '{repo_url}/projects/{pid}/variables'.format(
                 repo_url=self.repo_url,
                 pid=self.project_id,
@@ -447,7 +467,7 @@ class GitLab:
         headers = dict(self.headers)
         headers.update({'Content-Type': 'application/json'})
         # Make initial empty commit in repository
-        response = requests.post(
+        response = self.session.post(
             '{repo_url}/projects/{pid}/repository/commits'.format(
                 repo_url=self.repo_url,
                 pid=self.project_id,
@@ -463,7 +483,7 @@ class GitLab:
         projects, page = [], 1
         while True:
             url = ('{scheme}://{host}/api/{api_version}/groups/{encoded_namespace}/projects').format(**self.options)
-            response = requests.get(
+            response = self.session.get(
                 url,
                 headers=self.headers,
                 params=dict(simple=True, page=page, per_page=self.BATCH_SIZE),
@@ -476,13 +496,25 @@ class GitLab:
             page += 1
         return projects
 
+    @cached_property
+    def session(self):
+        session = requests.Session()
+        session.hooks['response'].append(self.count_response)
+        return session
+
+    @staticmethod
+    def count_response(response, *args, **kwargs):
+        method = response.request.method
+        metrics.HTTP_REQUESTS.inc(service='gitlab', method=method, status=response.status_code)
+        metrics.HTTP_SECONDS.observe(response.elapsed.total_seconds(), service='gitlab', method=method)
+
     @cached_property
     def headers(self):
         return {'Authorization': 'Bearer {token}'.format(**self.options)}
 
     @cached_property
     def merge_requests(self):
-        response = requests.get(
+        response = self.session.get(
             '{scheme}://{host}/api/{api_version}/{scope}merge_requests'.format(
                 scope=(f'projects/{self.project_id}/' if 'project' in self.options else ''),
                 **self.options,
@@ -502,7 +534,7 @@ class GitLab:
         return one(x for x in self.projects if x['path_with_namespace'] == path)['id']
 
     def create_merge_request(self, source_branch, target_branch, title):
-        response = requests.post(
+        response = self.session.post(
             '{scheme}://{host}/api/{api_version}/projects/{pid}/merge_requests'.format(
                 **self.options,
                 pid=self.project_id,
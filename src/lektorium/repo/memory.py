@@ -147,6 +147,7 @@ class Repo(BaseRepo):
                 custodian_email=custodian_email,
             )
         )
+        self.publish('ready', site_id, session_id, edit_url=site['sessions'][-1]['edit_url'])
         return session_id
 
     def destroy_session(self, session_id: str) -> None:
@@ -154,14 +155,16 @@ class Repo(BaseRepo):
             raise SessionNotFound()
         site = self.sessions[session_id][1]
         site['sessions'] = [x for x in site['sessions'] if x['session_id'] != session_id]
+        self.publish('destroyed', site['site_id'], session_id)
 
     def park_session(self, session_id: str) -> None:
         if session_id not in self.sessions:
             raise SessionNotFound()
-        session = self.sessions[session_id][0]
+        session, site = self.sessions[session_id]
         if session.pop('edit_url', None) is None:
             raise InvalidSessionState()
         session['parked_time'] = datetime.datetime.now()
+        self.publish('parked', site['site_id'], session_id)
 
     def unpark_session(self, session_id: str) -> None:
         if session_id not in self.sessions:
@@ -174,6 +177,7 @@ class Repo(BaseRepo):
         edit_url = f'https://{session_id}-unparked.example.com'
         session['edit_url'] = edit_url
         session.pop('parked_time', None)
+        self.publish('ready', site['site_id'], session_id, edit_url=edit_url)
 
     async def create_site(self, site_id, name, owner=None):
         owner, email = owner or self.DEFAULT_USER
@@ -187,6 +191,7 @@ class Repo(BaseRepo):
                 custodian_email=email,
             )
         )
+        self.publish('site-created', site_id)
 
     def request_release(self, session_id):
         if session_id not in self.sessions:
@@ -204,6 +209,7 @@ class Repo(BaseRepo):
                 release['source_branch'] = session_id
                 site.setdefault('releasing', []).append(release)
                 site['sessions'] = [session for session in site['sessions'] if session['session_id'] != session_id]
+                self.publish('released', site['site_id'], session_id)
 
     def __repr__(self):
         qname = f'{self.__class__.__module__}.{self.__class__.__name__}'
@@ -1,3 +1,6 @@
+import asyncio
+import base64
+import copy
 import functools
 from asyncio import Future, iscoroutine
 
@@ -6,6 +9,7 @@ from graphene import (
     Boolean,
     DateTime,
     Field,
+    Int,
     List,
     Mutation,
     ObjectType,
@@ -15,10 +19,14 @@ from graphene import (
 import lektorium.repo
 from lektorium.auth0 import Auth0Error
 
+from . import metrics, tracing
 from .jwt import GraphExecutionError
+from .loaders import DataLoader
+from .utils import nothing
 
 
 ADMIN = 'admin'
+JOBS_LIMIT = 1000
 
 
 class Site(ObjectType):
@@ -32,6 +40,13 @@ class Site(ObjectType):
     production_url = String()
     staging_url = String()
     sessions = List(lambda: Session)
+    cursor = String()
+
+    def resolve_sessions(self, info):
+        source = getattr(self, 'source', None)
+        if source is None:
+            return self.sessions
+        return source.get('sessions', None)
 
 
 class Session(ObjectType):
@@ -49,6 +64,7 @@ class Session(ObjectType):
     site = Field(Site)
     parked = Boolean()
     themes = List(String)
+    cursor = String()
 
     def resolve_production_url(self, info):
         return self.site.production_url
@@ -62,6 +78,14 @@ class Session(ObjectType):
     def resolve_parked(self, info):
         return not bool(self.edit_url)
 
+    def resolve_themes(self, info):
+        site = getattr(self, 'site', None)
+        if site is None:
+            return None
+        if not self.edit_url:
+            return []
+        return loaders(info).themes.load((site.site_id, self.session_id))
+
 
 class User(ObjectType):
     user_id = String()
@@ -101,6 +125,103 @@ class Releasing(ObjectType):
     created_at = DateTime()
 
 
+class Job(ObjectType):
+    time = DateTime()
+    event = String()
+    site_id = String()
+    session_id = String()
+
+
+class Loaders:
+    def __init__(self, context, operation):
+        self.context = context
+        self.operation = operation
+        self.sites = DataLoader(self.load_sites)
+        self.themes = DataLoader(self.load_themes)
+        self.user_permissions = DataLoader(self.load_user_permissions)
+
+    async def load_sites(self, site_ids):
+        sites = {x['site_id']: x for x in self.context['repo'].sites}
+        return [self.site(sites[x]) if x in sites else KeyError(x) for x in site_ids]
+
+    @staticmethod
+    def site(source):
+        site = Site(**{k: source[k] for k in source if k != 'sessions'})
+        site.source = source
+        return site
+
+    async def load_themes(self, keys):
+        repo = self.context['repo']
+        sessions_root = getattr(repo, 'sessions_root', None)
+        config_dir_themes = getattr(getattr(repo, 'storage', None), 'config_dir_themes', None)
+        if sessions_root is None or config_dir_themes is None:
+            return [[] for _ in keys]
+
+        def load():
+            return [config_dir_themes(sessions_root / site_id / session_id) for site_id, session_id in keys]
+
+        return await tracing.run_in_executor(load)
+
+    async def load_user_permissions(self, user_ids):
+        auth0_client = self.context['auth0_client']
+        return await asyncio.gather(
+            *(auth0_client.get_user_permissions(x) for x in user_ids),
+            return_exceptions=True,
+        )
+
+
+def loaders(info):
+    current = info.context.get('loaders', None)
+    if current is None or current.operation is not info.operation:
+        current = info.context['loaders'] = Loaders(info.context, info.operation)
+    return current
+
+
+SESSION_STATES = ('active', 'parked', 'starting', 'failed', 'ready')
+
+
+def session_states(session):
+    edit_url = session.get('edit_url', None)
+    if not edit_url:
+        return ('parked',)
+    if edit_url == 'Starting':
+        return ('active', 'starting')
+    if edit_url == 'Failed to start':
+        return ('active', 'failed')
+    return ('active', 'ready')
+
+
+def encode_cursor(index, key):
+    return base64.urlsafe_b64encode(f'{index}:{key}'.encode()).decode()
+
+
+def paginate(items, key, first=None, after=None):
+    start = 0
+    if after is not None:
+        try:
+            index, _, after_key = base64.urlsafe_b64decode(after.encode()).decode().partition(':')
+            index = int(index)
+        except (UnicodeDecodeError, ValueError):
+            raise GraphExecutionError('Invalid cursor', code=400)
+        keys = [key(x) for x in items]
+        if index < len(keys) and keys[index] == after_key:
+            start = index + 1
+        elif after_key in keys:
+            start = keys.index(after_key) + 1
+        else:
+            start = index
+    end = len(items) if first is None else start + max(first, 0)
+    return [(encode_cursor(i, key(items[i])), items[i]) for i in range(start, min(end, len(items)))]
+
+
+def has_site_permission(permissions, site_id):
+    return ADMIN in permissions or f'user:{site_id}' in permissions
+
+
+def site_matches(site, permissions, site_id=None):
+    return site_id in (None, site['site_id']) and has_site_permission(permissions, site['site_id'])
+
+
 def skip_permissions_check(info):
     return info.context.get('skip_permissions_check', False)
 
@@ -143,40 +264,82 @@ def inject_permissions(wrapped=None, admin=False):
 
 
 class Query(ObjectType):
-    sites = List(Site)
-    sessions = List(Session, parked=Boolean(default_value=False))
+    sites = List(
+        Site,
+        site_id=String(),
+        custodian=String(),
+        first=Int(),
+        after=String(),
+    )
+    sessions = List(
+        Session,
+        parked=Boolean(default_value=False),
+        site_id=String(),
+        custodian=String(),
+        state=String(),
+        first=Int(),
+        after=String(),
+    )
     users = List(User)
     themes = List(Theme, site_id=String(default_value=None))
     user_permissions = List(Permission, user_id=String())
     available_permissions = List(ApiPermission)
     releasing = List(Releasing)
-
-    @staticmethod
-    def sessions_list(repo):
-        for site in repo.sites:
-            site = Site(**site)
-            for session in site.sessions or ():
-                themes = []
-                if bool(session.edit_url):
-                    session_dir = repo.sessions_root / site.site_id / session['session_id']
-                    themes = repo.storage.config_dir_themes(session_dir)
-                yield dict(**session, themes=themes, site=site)
+    jobs = List(Job, site_id=String(), session_id=String(), limit=Int(default_value=100))
 
     @inject_permissions
     @repo
-    async def resolve_sites(self, info, repo, permissions):
-        return [Site(**x) for x in repo.sites if ADMIN in permissions or f'user:{x["site_id"]}' in permissions]
+    async def resolve_sites(
+        self,
+        info,
+        repo,
+        permissions,
+        site_id=None,
+        custodian=None,
+        first=None,
+        after=None,
+    ):
+        site_ids = set(repo.find_sites(custodian))
+        sites = [x for x in repo.sites if x['site_id'] in site_ids and site_matches(x, permissions, site_id)]
+        page = paginate(sites, lambda x: x['site_id'], first, after)
+        sites = await loaders(info).sites.load_many([x['site_id'] for _, x in page])
+        result = []
+        for (cursor, _), site in zip(page, sites):
+            site = copy.copy(site)
+            site.cursor = cursor
+            result.append(site)
+        return result
 
     @inject_permissions
     @repo
-    async def resolve_sessions(self, info, parked, repo, permissions):
+    async def resolve_sessions(
+        self,
+        info,
+        parked,
+        repo,
+        permissions,
+        site_id=None,
+        custodian=None,
+        state=None,
+        first=None,
+        after=None,
+    ):
+        if state is None:
+            state = 'parked' if parked else 'active'
+        if state not in SESSION_STATES:
+            raise GraphExecutionError(f'Unknown session state {state}', code=400)
         await repo.init_sessions()
-        sessions = (Session(**x) for x in Query.sessions_list(repo))
-        return [
-            x
-            for x in sessions
-            if (bool(x.edit_url) != parked and (ADMIN in permissions or f'user:{x.site.site_id}' in permissions))
-        ]
+        site_ids = [x['site_id'] for x in repo.sites if site_matches(x, permissions, site_id)]
+        parked = {'parked': True, 'active': False}.get(state, None)
+        index, order = repo.sessions, {x: i for i, x in enumerate(site_ids)}
+        sessions = sorted(
+            (index[x] for x in repo.find_sessions(site_ids, custodian, parked)),
+            key=lambda x: order[x[1]['site_id']],
+        )
+        sessions = [x for x in sessions if state in session_states(x[0])]
+        page = paginate(sessions, lambda x: x[0]['session_id'], first, after)
+        sites = await loaders(info).sites.load_many([site['site_id'] for _, (_, site) in page])
+        return [Session(**session, site=site, cursor=cursor) for (cursor, (session, _)), site in zip(page, sites)]
 
     @inject_permissions(admin=True)
     async def resolve_users(self, info, permissions):
@@ -191,8 +354,7 @@ class Query(ObjectType):
 
     @inject_permissions(admin=True)
     async def resolve_user_permissions(self, info, user_id, permissions):
-        auth0_client = info.context['auth0_client']
-        return [Permission(**x) for x in await auth0_client.get_user_permissions(user_id)]
+        return [Permission(**x) for x in await loaders(info).user_permissions.load(user_id)]
 
     @inject_permissions(admin=True)
     @repo
@@ -205,6 +367,16 @@ class Query(ObjectType):
             )
         ]
 
+    @inject_permissions
+    @repo
+    async def resolve_jobs(self, info, repo, permissions, site_id=None, session_id=None, limit=100):
+        site_ids = None
+        if ADMIN not in permissions:
+            site_ids = [x['site_id'] for x in repo.sites if has_site_permission(permissions, x['site_id'])]
+        jobs = repo.jobs(site_id, session_id, max(min(limit, JOBS_LIMIT), 0), site_ids)
+        fields = ('time', 'event', 'site_id', 'session_id')
+        return [Job(**{k: x[k] for k in fields}) for x in jobs]
+
     @inject_permissions
     @repo
     async def resolve_releasing(self, info, repo, permissions):
@@ -224,6 +396,10 @@ class MutationBase(Mutation):
     def mutate_allowed(cls, permissions, **kwargs):
         return False
 
+    @classmethod
+    def transition(cls, target, site_id=None, session_id=None, **kwargs):
+        return target.transition(site_id=site_id, session_id=session_id)
+
     @classmethod
     async def mutate(cls, root, info, **kwargs):
         if not skip_permissions_check(info):
@@ -232,13 +408,18 @@ class MutationBase(Mutation):
                 if not cls.mutate_allowed(permissions, **kwargs):
                     raise PermissionError()
 
-        try:
-            method = getattr(info.context[cls.TARGET], cls.REPO_METHOD)
-            result = method(**kwargs)
-            if isinstance(result, Future) or iscoroutine(result):
-                await result
-        except (Auth0Error, lektorium.repo.ExceptionBase):
-            return MutationResult(ok=False)
+        attributes = {k: v for k, v in kwargs.items() if k in ('site_id', 'session_id', 'user_id')}
+        mutation_span = tracing.span(f'mutation.{cls.__name__}', **attributes)
+        with mutation_span, metrics.MUTATION_SECONDS.time(mutation=cls.__name__) as labels:
+            try:
+                target = info.context[cls.TARGET]
+                async with cls.transition(target, **kwargs):
+                    result = getattr(target, cls.REPO_METHOD)(**kwargs)
+                    if isinstance(result, Future) or iscoroutine(result):
+                        await result
+            except (Auth0Error, lektorium.repo.ExceptionBase):
+                labels['result'] = 'failed'
+                return MutationResult(ok=False)
 
         return MutationResult(ok=True)
 
@@ -246,6 +427,10 @@ class MutationBase(Mutation):
 class ChangePermissionsMixin:
     TARGET = 'auth0_client'
 
+    @classmethod
+    def transition(cls, target, **kwargs):
+        return nothing()
+
     class Arguments:
         user_id = String()
         permissions = List(String)
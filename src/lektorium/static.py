@@ -0,0 +1,129 @@
+import gzip
+import hashlib
+import mimetypes
+import pathlib
+import re
+
+import aiohttp.web
+
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Asset:
+    COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+    MIN_SIZE = 256
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.content_type = content_type
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        self.encoded = {}
+        if content_type.startswith(self.COMPRESSIBLE) and len(body) >= self.MIN_SIZE:
+            for encoding, compress in self.compressors().items():
+                compressed = compress(body)
+                if len(compressed) < len(body):
+                    self.encoded[encoding] = compressed
+
+    @staticmethod
+    def compressors():
+        result = {}
+        if brotli is not None:
+            result['br'] = brotli.compress
+        result['gzip'] = lambda body: gzip.compress(body, compresslevel=9, mtime=0)
+        return result
+
+    def etag(self, encoding):
+        return f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+
+
+class StaticAssets:
+    PREFIXES = ('components', 'images', 'scripts')
+    CONTENT_TYPES = {'.vue': 'text/plain', '.js': 'application/javascript'}
+    IMMUTABLE = 'public, max-age=31536000, immutable'
+    REVALIDATE = 'no-cache'
+
+    def __init__(self, root, prefixes=PREFIXES):
+        self.root = pathlib.Path(root)
+        self.prefixes = prefixes
+        self.sources = {
+            f'/{path.relative_to(self.root).as_posix()}': path
+            for prefix in prefixes
+            for path in sorted((self.root / prefix).rglob('*'))
+            if path.is_file()
+        }
+        self.reference = re.compile(
+            r'''(['"])(/(?:{})/[^'"?#]+)\1'''.format('|'.join(re.escape(x) for x in prefixes)),
+        )
+        self.assets = {}
+        for url in self.sources:
+            self.load(url, ())
+        self.index = self.asset((self.root / 'public' / 'index.html').read_bytes(), 'text/html', ())
+
+    def content_type(self, path):
+        content_type = self.CONTENT_TYPES.get(path.suffix, None) or mimetypes.guess_type(path.name)[0]
+        return content_type or 'application/octet-stream'
+
+    def load(self, url, loading):
+        if url not in self.assets:
+            path = self.sources[url]
+            self.assets[url] = self.asset(path.read_bytes(), self.content_type(path), (*loading, url))
+        return self.assets[url]
+
+    def asset(self, body, content_type, loading):
+        if content_type.startswith(Asset.COMPRESSIBLE):
+            body = self.reference.sub(lambda match: self.versioned(match, loading), body.decode()).encode()
+        return Asset(body, content_type)
+
+    def versioned(self, match, loading):
+        quote, url = match.groups()
+        if url not in self.sources or url in loading:
+            return match.group(0)
+        return f'{quote}{url}?v={self.load(url, loading).digest}{quote}'
+
+    @staticmethod
+    def negotiate(request, asset):
+        accepted = {
+            x.split(';')[0].strip()
+            for x in request.headers.get('Accept-Encoding', '').split(',')
+            if not x.strip().endswith(';q=0')
+        }
+        return next((x for x in asset.encoded if x in accepted), None)
+
+    def respond(self, request, asset, cache_control):
+        encoding = self.negotiate(request, asset)
+        headers = {
+            'ETag': asset.etag(encoding),
+            'Cache-Control': cache_control,
+            'Vary': 'Accept-Encoding',
+        }
+        if request.headers.get('If-None-Match', None) == headers['ETag']:
+            return aiohttp.web.Response(status=304, headers=headers)
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        return aiohttp.web.Response(
+            body=asset.encoded[encoding] if encoding else asset.body,
+            content_type=asset.content_type,
+            charset='utf-8' if asset.content_type.startswith('text/') else None,
+            headers=headers,
+        )
+
+    async def handler(self, request):
+        asset = self.assets.get(request.path, None)
+        if asset is None:
+            raise aiohttp.web.HTTPNotFound()
+        immutable = request.query.get('v', None) == asset.digest
+        return self.respond(request, asset, self.IMMUTABLE if immutable else self.REVALIDATE)
+
+    async def index_handler(self, request):
+        return self.respond(request, self.index, self.REVALIDATE)
+
+    def register(self, router):
+        for url in self.assets:
+            router.add_get(url, self.handler)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}("{self.root}")'
@@ -0,0 +1,283 @@
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+import urllib.request
+import uuid
+
+import aiohttp.web
+
+
+CURRENT_SPAN = contextvars.ContextVar('lektorium_span', default=None)
+REQUEST_ID = contextvars.ContextVar('lektorium_request_id', default=None)
+REQUEST_ID_HEADER = 'X-Request-ID'
+REQUEST_ID_PATTERN = re.compile(r'^[\w.:-]{1,64}$')
+LOG_FORMAT = '%(asctime)s.%(msecs)03d [%(name)s] [%(request_id)s] %(message)s'
+
+
+class Span:
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = {k: v for k, v in (attributes or {}).items() if v is not None}
+        request_id = REQUEST_ID.get()
+        if request_id is not None:
+            self.attributes.setdefault('request_id', request_id)
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration(self):
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'end': self.end,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}("{self.name}", {self.trace_id}/{self.span_id})'
+
+
+class Tracer:
+    def __init__(self):
+        self.processors = []
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        span = Span(name, CURRENT_SPAN.get(), attributes)
+        token = CURRENT_SPAN.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.error = repr(exc)
+            raise
+        finally:
+            span.end = time.time_ns()
+            CURRENT_SPAN.reset(token)
+            for processor in self.processors:
+                processor.add(span)
+
+    def flush(self):
+        for processor in self.processors:
+            processor.flush()
+
+
+class FileExporter:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(x.to_dict()) + '\n' for x in spans)
+        with self.lock, open(self.path, 'a') as trace_file:
+            trace_file.write(lines)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}("{self.path}")'
+
+
+class OTLPExporter:
+    TIMEOUT = 5
+
+    def __init__(self, endpoint, service_name='lektorium', timeout=TIMEOUT):
+        self.endpoint = endpoint.rstrip('/')
+        if not self.endpoint.endswith('/v1/traces'):
+            self.endpoint = f'{self.endpoint}/v1/traces'
+        self.service_name = service_name
+        self.timeout = timeout
+
+    @staticmethod
+    def attribute(key, value):
+        if isinstance(value, bool):
+            return {'key': key, 'value': {'boolValue': value}}
+        if isinstance(value, int):
+            return {'key': key, 'value': {'intValue': str(value)}}
+        if isinstance(value, float):
+            return {'key': key, 'value': {'doubleValue': value}}
+        return {'key': key, 'value': {'stringValue': str(value)}}
+
+    def payload(self, spans):
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [self.attribute('service.name', self.service_name)]},
+                'scopeSpans': [{
+                    'scope': {'name': 'lektorium'},
+                    'spans': [
+                        {
+                            'traceId': x.trace_id,
+                            'spanId': x.span_id,
+                            'parentSpanId': x.parent_id or '',
+                            'name': x.name,
+                            'kind': 1,
+                            'startTimeUnixNano': str(x.start),
+                            'endTimeUnixNano': str(x.end),
+                            'attributes': [self.attribute(k, v) for k, v in x.attributes.items()],
+                            'status': {'code': 2, 'message': x.error} if x.error else {'code': 1},
+                        }
+                        for x in spans
+                    ],
+                }],
+            }],
+        }
+
+    def export(self, spans):
+        request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(self.payload(spans)).encode(),
+            headers={'Content-Type': 'application/json'},
+            method='POST',
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}("{self.endpoint}")'
+
+
+class BatchProcessor:
+    SIZE = 512
+    INTERVAL = 5
+    MAX_QUEUE = 8192
+
+    def __init__(self, exporter, size=SIZE, interval=INTERVAL, max_queue=MAX_QUEUE):
+        self.exporter = exporter
+        self.size = size
+        self.interval = interval
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, span):
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.worker, name='lektorium-tracing', daemon=True)
+            self.thread.start()
+
+    def worker(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.interval)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self.export(batch)
+
+    def flush(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.export(batch)
+
+    def export(self, batch):
+        try:
+            with self.lock:
+                self.exporter.export(batch)
+        except Exception:
+            logging.getLogger('lektorium.tracing').exception(f'{self.exporter} failed to export {len(batch)} spans')
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.exporter})'
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        span = CURRENT_SPAN.get()
+        record.request_id = REQUEST_ID.get() or '-'
+        record.trace_id = span.trace_id if span is not None else '-'
+        return True
+
+
+TRACER = Tracer()
+span = TRACER.span
+
+
+def current_span():
+    return CURRENT_SPAN.get()
+
+
+def configure(trace_file=None, otlp_endpoint=None):
+    trace_file = trace_file or os.environ.get('LEKTORIUM_TRACE_FILE', None)
+    otlp_endpoint = otlp_endpoint or os.environ.get('LEKTORIUM_OTLP_ENDPOINT', None)
+    TRACER.processors = []
+    if trace_file:
+        TRACER.processors.append(BatchProcessor(FileExporter(trace_file)))
+    if otlp_endpoint:
+        TRACER.processors.append(BatchProcessor(OTLPExporter(otlp_endpoint)))
+    if TRACER.processors:
+        atexit.register(TRACER.flush)
+    return TRACER
+
+
+def install_logging(logger=None):
+    for handler in (logger or logging.getLogger()).handlers:
+        if not any(isinstance(x, RequestIdFilter) for x in handler.filters):
+            handler.addFilter(RequestIdFilter())
+        datefmt = handler.formatter.datefmt if handler.formatter is not None else None
+        handler.setFormatter(logging.Formatter(fmt=LOG_FORMAT, datefmt=datefmt))
+
+
+def run_in_executor(func, *args, **kwargs):
+    context = contextvars.copy_context()
+    return asyncio.get_event_loop().run_in_executor(
+        None,
+        functools.partial(context.run, func, *args, **kwargs),
+    )
+
+
+@aiohttp.web.middleware
+async def request_middleware(request, handler):
+    request_id = request.headers.get(REQUEST_ID_HEADER, '')
+    if not REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex
+    token = REQUEST_ID.set(request_id)
+    try:
+        with span('http.request', method=request.method, path=request.path) as current:
+            try:
+                response = await handler(request)
+            except aiohttp.web.HTTPException as exc:
+                current.set(status=exc.status)
+                exc.headers[REQUEST_ID_HEADER] = request_id
+                raise
+            current.set(status=response.status)
+    finally:
+        REQUEST_ID.reset(token)
+    if not response.prepared:
+        response.headers[REQUEST_ID_HEADER] = request_id
+    return response
@@ -1,5 +1,9 @@
+import asyncio
 import atexit
+import collections
 import contextlib
+import importlib.util
+import sys
 
 
 def closer(manager):
@@ -7,3 +11,47 @@ def closer(manager):
     result = closer.enter_context(manager)
     atexit.register(closer.close)
     return result
+
+
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f'No module named {name!r}', name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+@contextlib.asynccontextmanager
+async def nothing():
+    yield
+
+
+class KeyedLocks:
+    def __init__(self):
+        self.locks = {}
+        self.users = collections.Counter()
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, key):
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        self.users[key] += 1
+        try:
+            async with self.locks[key]:
+                yield
+        finally:
+            self.users[key] -= 1
+            if not self.users[key]:
+                del self.users[key]
+                del self.locks[key]
+
+    def __len__(self):
+        return len(self.locks)
@@ -0,0 +1,321 @@
+import asyncio
+import collections
+import functools
+import hashlib
+import json
+import math
+import time
+
+import aiohttp.web
+import aiohttp_graphql
+from graphql import parse, validate
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from graphql.execution import ExecutionResult, execute
+from graphql.language import ast
+from graphql_server import HttpQueryError, encode_execution_results, load_json_variables, run_http_query
+from promise import Promise
+
+from .cost import CostLimiter, QueryCost
+from .jwt import GraphExecutionError, JWTMiddleware
+
+
+def digest(query):
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+class DocumentCache(GraphQLBackend):
+    SIZE = 512
+
+    def __init__(self, size=SIZE):
+        self.size = size
+        self.documents = collections.OrderedDict()
+
+    def document_from_string(self, schema, document_string):
+        key = (schema, digest(document_string))
+        document = self.documents.get(key, None)
+        if document is None:
+            document = self.documents[key] = self.build(schema, document_string)
+            while len(self.documents) > self.size:
+                self.documents.popitem(last=False)
+        else:
+            self.documents.move_to_end(key)
+        return document
+
+    @staticmethod
+    def build(schema, document_string):
+        document_ast = parse(document_string)
+        errors = validate(schema, document_ast)
+        if errors:
+            def run(*args, **kwargs):
+                return ExecutionResult(errors=errors, invalid=True)
+        else:
+            run = functools.partial(execute, schema, document_ast)
+        return GraphQLDocument(schema, document_string, document_ast, run)
+
+    def __len__(self):
+        return len(self.documents)
+
+
+class PersistedQueries:
+    SIZE = 1024
+
+    def __init__(self, size=SIZE):
+        self.size = size
+        self.queries = collections.OrderedDict()
+
+    def lookup(self, key):
+        query = self.queries.get(key, None)
+        if query is not None:
+            self.queries.move_to_end(key)
+        return query
+
+    def store(self, key, query):
+        self.queries[key] = query
+        self.queries.move_to_end(key)
+        while len(self.queries) > self.size:
+            self.queries.popitem(last=False)
+
+    def resolve(self, data, query_data):
+        if isinstance(data, list):
+            return [self.resolve(x, {}) for x in data]
+        if not isinstance(data, dict):
+            return data
+        extensions = data.get('extensions', None) or query_data.get('extensions', None)
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpQueryError(400, 'Extensions are invalid JSON.')
+        persisted = (extensions or {}).get('persistedQuery', None)
+        if not persisted:
+            return data
+        key = persisted.get('sha256Hash', None)
+        query = data.get('query', None) or query_data.get('query', None)
+        if query:
+            if digest(query) != key:
+                raise HttpQueryError(400, 'Provided sha256Hash does not match query')
+            self.store(key, query)
+            return data
+        query = self.lookup(key)
+        if query is None:
+            raise HttpQueryError(400, 'PersistedQueryNotFound')
+        return {**data, 'query': query}
+
+
+class ResponseCache:
+    SIZE = 256
+    TTL = 60
+    FIELDS = frozenset(('__typename', 'themes', 'availablePermissions'))
+
+    def __init__(self, size=SIZE, ttl=TTL):
+        self.size = size
+        self.ttl = ttl
+        self.responses = collections.OrderedDict()
+        self.generation = 0
+
+    def get(self, key):
+        if key not in self.responses:
+            return None
+        response, expires = self.responses[key]
+        if expires <= time.monotonic():
+            del self.responses[key]
+            return None
+        self.responses.move_to_end(key)
+        return response
+
+    def set(self, key, response, generation):
+        if generation != self.generation:
+            return
+        self.responses[key] = (response, time.monotonic() + self.ttl)
+        self.responses.move_to_end(key)
+        while len(self.responses) > self.size:
+            self.responses.popitem(last=False)
+
+    def clear(self):
+        self.generation += 1
+        self.responses.clear()
+
+    @classmethod
+    def cacheable(cls, document, operation_name):
+        operations = [x for x in document.document_ast.definitions if isinstance(x, ast.OperationDefinition)]
+        if operation_name:
+            operations = [x for x in operations if x.name and x.name.value == operation_name]
+        if len(operations) != 1 or operations[0].operation != 'query':
+            return False
+        return all(
+            isinstance(x, ast.Field) and x.name.value in cls.FIELDS
+            for x in operations[0].selection_set.selections
+        )
+
+    def __len__(self):
+        return len(self.responses)
+
+
+class GraphQLView(aiohttp_graphql.GraphQLView):
+    MAX_COST = 1000
+    MAX_DEPTH = 6
+
+    def __init__(
+        self,
+        *,
+        authorizer=None,
+        backend=None,
+        persisted_queries=None,
+        response_cache=None,
+        cost=None,
+        limiter=None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.authorizer = authorizer
+        self.backend = backend or DocumentCache()
+        self.persisted_queries = persisted_queries or PersistedQueries()
+        self.response_cache = response_cache or ResponseCache()
+        self.cost = cost or QueryCost(self.schema)
+        self.limiter = limiter or CostLimiter()
+
+    async def parse_body(self, request):
+        return self.persisted_queries.resolve(await super().parse_body(request), request.query)
+
+    def document(self, query):
+        try:
+            return self.backend.document_from_string(self.schema, query)
+        except Exception:
+            return None
+
+    def documents(self, data, query_data):
+        for entry in data if isinstance(data, list) else [data]:
+            if not isinstance(entry, dict):
+                continue
+            query = entry.get('query', None) or query_data.get('query', None)
+            document = self.document(query) if query else None
+            if document is not None:
+                operation_name = entry.get('operationName', None) or query_data.get('operationName', None)
+                try:
+                    variables = load_json_variables(entry.get('variables', None) or query_data.get('variables', None))
+                except HttpQueryError:
+                    variables = None
+                yield document, operation_name, variables if isinstance(variables, dict) else None
+
+    def is_mutation(self, data, query_data):
+        return any(
+            document.get_operation_type(operation_name) == 'mutation'
+            for document, operation_name, _ in self.documents(data, query_data)
+        )
+
+    async def identity(self, request, context):
+        if self.authorizer is None:
+            return None, context.get('user_permissions', ())
+        if JWTMiddleware.CONTEXT_KEY not in context:
+            context[JWTMiddleware.CONTEXT_KEY] = asyncio.ensure_future(self.authorizer.info(request))
+        return await context[JWTMiddleware.CONTEXT_KEY]
+
+    async def limit(self, data, request, context):
+        total = 0
+        for document, operation_name, variables in self.documents(data, request.query):
+            cost, depth = self.cost.analyze(document, operation_name, variables)
+            if depth > self.MAX_DEPTH:
+                raise HttpQueryError(400, f'Query depth {depth} exceeds limit {self.MAX_DEPTH}')
+            total += cost
+        if total > self.MAX_COST:
+            raise HttpQueryError(400, f'Query cost {total} exceeds budget {self.MAX_COST}')
+        try:
+            userdata, _ = await self.identity(request, context)
+        except GraphExecutionError:
+            userdata = None
+        key = userdata[1] if userdata else getattr(request, 'remote', None)
+        delay = self.limiter.reserve(key, total)
+        if delay > self.limiter.max_delay:
+            raise HttpQueryError(
+                429,
+                'Query rate limit exceeded',
+                headers={'Retry-After': str(math.ceil(delay))},
+            )
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def cache_key(self, data, request, context):
+        if not isinstance(data, dict):
+            return None
+        query = data.get('query', None) or request.query.get('query', None)
+        operation_name = data.get('operationName', None) or request.query.get('operationName', None)
+        document = self.document(query) if query else None
+        if document is None or not self.response_cache.cacheable(document, operation_name):
+            return None
+        variables = load_json_variables(data.get('variables', None) or request.query.get('variables', None))
+        try:
+            _, permissions = await self.identity(request, context)
+        except GraphExecutionError:
+            return None
+        return (
+            digest(query),
+            operation_name,
+            json.dumps(variables, sort_keys=True),
+            tuple(sorted(permissions)),
+        )
+
+    async def __call__(self, request):
+        try:
+            data = await self.parse_body(request)
+            request_method = request.method.lower()
+            is_graphiql = self.is_graphiql(request)
+            is_pretty = self.is_pretty(request)
+
+            if request_method == 'options':
+                return self.process_preflight(request)
+
+            context = self.get_context(request)
+            cache_key = None
+            if request_method in ('get', 'post'):
+                await self.limit(data, request, context)
+                if not is_graphiql:
+                    cache_key = await self.cache_key(data, request, context)
+            if cache_key is not None and not is_pretty:
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    return aiohttp.web.Response(text=cached, content_type='application/json')
+            generation = self.response_cache.generation
+
+            execution_results, all_params = run_http_query(
+                self.schema,
+                request_method,
+                data,
+                query_data=request.query,
+                batch_enabled=self.batch,
+                catch=is_graphiql,
+                backend=self.backend,
+                return_promise=self.enable_async,
+                root_value=self.root_value,
+                context_value=context,
+                middleware=self.middleware,
+                executor=self.executor,
+            )
+
+            awaited_execution_results = await Promise.all(execution_results)
+            if self.is_mutation(data, request.query):
+                self.response_cache.clear()
+            result, status_code = encode_execution_results(
+                awaited_execution_results,
+                is_batch=isinstance(data, list),
+                format_error=self.error_formatter,
+                encode=functools.partial(self.encoder, pretty=is_pretty),
+            )
+
+            if is_graphiql:
+                return await self.render_graphiql(params=all_params[0], result=result)
+
+            if cache_key is not None and not is_pretty and status_code == 200:
+                if not any(x is None or x.errors for x in awaited_execution_results):
+                    self.response_cache.set(cache_key, result, generation)
+
+            return aiohttp.web.Response(text=result, status=status_code, content_type='application/json')
+
+        except HttpQueryError as err:
+            if err.headers and isinstance(err.headers.get('Allow', None), list):
+                err.headers['Allow'] = ', '.join(err.headers['Allow'])
+            return aiohttp.web.Response(
+                text=self.encoder({'errors': [self.error_formatter(err)]}),
+                status=err.status_code,
+                headers=err.headers,
+                content_type='application/json',
+            )
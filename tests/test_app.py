@@ -1,8 +1,14 @@
+import asyncio
+import functools
 from unittest.mock import patch
 
+import aiohttp.test_utils
+import aiohttp.web
 import pytest
 
+import lektorium.repo
 from lektorium import app
+from lektorium.jwt import GraphExecutionError
 
 
 def test_app():
@@ -10,7 +16,7 @@ def test_app():
         app.create_app(app.RepoType.LOCAL, '', '')
         local_repo.assert_called_once()
         (storage, *_), kwargs = local_repo.call_args
-        assert kwargs == dict(sessions_root=None)
+        assert kwargs == dict(sessions_root=None, state_path=None)
         assert hasattr(storage, 'config')
 
 
@@ -24,3 +30,29 @@ async def test_index(aiohttp_client, loop):
     assert response.status == 200
     assert 'lektoriumAuth0Config' in await response.text()
     assert 'test.auth0.com' in await response.text()
+
+
+class Authorizer:
+    async def verify(self, headers):
+        if headers['Authorization'] != 'Bearer good':
+            raise GraphExecutionError('Invalid token', code=401)
+        return None, ['user:bow']
+
+
+@pytest.mark.asyncio
+async def test_events_authentication():
+    repo = lektorium.repo.ListRepo([])
+    application = aiohttp.web.Application()
+    application.router.add_get('/events', functools.partial(app.events_handler, repo, Authorizer()))
+    async with aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(application)) as client:
+        async with client.ws_connect('/events?token=good') as websocket:
+            await websocket.send_json({'token': 'bad'})
+            await websocket.receive()
+            assert websocket.close_code == app.EVENTS_UNAUTHORIZED
+        async with client.ws_connect('/events') as websocket:
+            await websocket.send_json({'token': 'good'})
+            await asyncio.sleep(0.05)
+            repo.publish('ready', 'uci', 'a')
+            repo.publish('ready', 'bow', 'b')
+            event = await websocket.receive_json(timeout=1)
+            assert (event['event'], event['session_id']) == ('ready', 'b')
@@ -1,9 +1,17 @@
+import asyncio
 import functools
+import time
 
 import pytest
 from aioresponses import aioresponses
 
-from lektorium.auth0 import Auth0Client, Auth0Error, FakeAuth0Client
+from lektorium.auth0 import (
+    Auth0Client,
+    Auth0Error,
+    FakeAuth0Client,
+    LRUCache,
+    TokenBucket,
+)
 
 
 TEST_TOKEN = {'access_token': 'test_token'}
@@ -54,7 +62,7 @@ def mocked(auth0_client):
 async def test_auth_token(auth0_client, mocked):
     assert (await auth0_client.auth_token) == 'test_token'
     mocked.post(auth0_client.token_url, status=404)
-    auth0_client.token_time = 0
+    auth0_client.token_expires = 0
     requests = list(mocked.requests.values())
     assert len(requests) == 1
     assert len(requests[0]) == 1
@@ -64,9 +72,51 @@ async def test_auth_token(auth0_client, mocked):
         await auth0_client.auth_token
 
 
+@pytest.mark.asyncio
+async def test_auth_token_single_flight(auth0_client):
+    with aioresponses() as mocked:
+        mocked.post(
+            auth0_client.token_url,
+            status=200,
+            payload={'access_token': 'first', 'expires_in': 600},
+        )
+        tokens = await asyncio.gather(*(auth0_client.auth_token for _ in range(3)))
+        assert tokens == ['first'] * 3
+        assert auth0_client.token_expires - time.time() > 590
+        mocked.post(
+            auth0_client.token_url,
+            status=200,
+            payload={'access_token': 'second', 'expires_in': 600},
+        )
+        auth0_client.token_refresh_time = 0
+        assert (await auth0_client.auth_token) == 'first'
+        await auth0_client.token_refresh
+        assert (await auth0_client.auth_token) == 'second'
+
+
+@pytest.mark.asyncio
+async def test_auth_token_cancellation(auth0_client):
+    fetched = asyncio.Event()
+
+    async def fetch_token():
+        await fetched.wait()
+        auth0_client.token, auth0_client.token_expires = 'first', time.time() + 600
+        return auth0_client.token
+
+    auth0_client.fetch_token = fetch_token
+    first = asyncio.ensure_future(auth0_client.auth_token)
+    second = asyncio.ensure_future(auth0_client.auth_token)
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    fetched.set()
+    assert await second == 'first'
+    assert first.cancelled()
+
+
 @pytest.mark.asyncio
 async def test_get_users(auth0_client, mocked):
-    url = f'{auth0_client.audience}/users?fields=name,nickname,email,user_id&per_page=100'
+    url = f'{auth0_client.audience}/users?fields=name,nickname,email,user_id&page=0&per_page=100'
     users_response = [{
         'username': 'mjekov',
     }]
@@ -78,6 +128,35 @@ async def test_get_users(auth0_client, mocked):
         await auth0_client.get_users()
 
 
+@pytest.mark.asyncio
+async def test_get_users_paged(auth0_client, mocked):
+    auth0_client.USERS_PAGE_SIZE = 2
+    url = f'{auth0_client.audience}/users?fields=name,nickname,email,user_id&per_page=2'
+    mocked.get(f'{url}&page=0', status=200, payload=[{'user_id': 'a'}, {'user_id': 'b'}])
+    mocked.get(f'{url}&page=1', status=200, payload=[{'user_id': 'c'}])
+    for user_id in 'abc':
+        mocked.get(
+            f'{auth0_client.audience}/users/{user_id}/permissions?per_page=100',
+            status=200,
+            payload=[{'permission_name': f'user:{user_id}'}],
+        )
+    users = await auth0_client.get_users()
+    assert [x['permissions'] for x in users] == [['user:a'], ['user:b'], ['user:c']]
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=1, capacity=2)
+    assert bucket.delay() == 0
+    assert bucket.delay() == 0
+    assert bucket.delay() > 0
+    bucket.update({'X-RateLimit-Limit': '5', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '0'})
+    assert bucket.capacity == 5
+    assert bucket.delay() == 0
+    reset = int(time.time()) + 10
+    bucket.update({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': f'{reset}'})
+    assert bucket.delay() > 5
+
+
 @pytest.mark.asyncio
 async def test_get_user_permissions(auth0_client, mocked):
     url = f'{auth0_client.audience}/users/user_id/permissions?per_page=100'
@@ -152,3 +231,46 @@ async def test_get_api_permissions(auth0_client, mocked):
     mocked.get(url, status=200, payload=[])
     with pytest.raises(Auth0Error):
         await auth0_client.get_api_permissions()
+
+
+@pytest.mark.asyncio
+async def test_lru_cache():
+    cache, calls = LRUCache(maxsize=2, stale_period=10), []
+
+    async def loader(value):
+        calls.append(value)
+        await asyncio.sleep(0)
+        return value
+
+    results = await asyncio.gather(*(cache.get('a', functools.partial(loader, 1), 5) for _ in range(3)))
+    assert results == [1, 1, 1]
+    assert calls == [1]
+    assert cache.metrics['coalesced'] == 2
+    await cache.get('b', functools.partial(loader, 2))
+    await cache.get('c', functools.partial(loader, 3))
+    assert 'a' not in cache and len(cache) == 2
+    cache.entries['b'] = (2, time.time() - 7)
+    assert await cache.get('b', functools.partial(loader, 4), 5) == 2
+    await asyncio.sleep(0.01)
+    assert await cache.get('b', functools.partial(loader, 5), 5) == 4
+    assert cache.pop('b') == 4
+    assert 'b' not in cache
+
+
+@pytest.mark.asyncio
+async def test_lru_cache_cancellation():
+    cache, loaded = LRUCache(), asyncio.Event()
+
+    async def loader():
+        await loaded.wait()
+        return 1
+
+    first = asyncio.ensure_future(cache.get('a', loader))
+    second = asyncio.ensure_future(cache.get('a', loader))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    loaded.set()
+    assert await second == 1
+    assert first.cancelled()
+    assert 'a' in cache and cache.metrics['errors'] == 0
@@ -1,5 +1,7 @@
+import asyncio
 import collections
 import copy
+import unittest.mock
 
 import graphene.test
 import pytest
@@ -8,6 +10,7 @@ from graphql.execution.executors.asyncio import AsyncioExecutor
 import lektorium.repo
 import lektorium.schema
 from lektorium.auth0 import FakeAuth0Client
+from lektorium.repo.local import FakeLektor, FakeServer, FileStorage
 
 
 def deorder(obj):
@@ -580,3 +583,123 @@ def test_delete_permissions(client):
             },
         },
     }
+
+
+def test_session_themes(client):
+    result = client.execute(r'''{
+        sessions {
+            sessionId
+            themes
+        }
+        parked: sessions(parked: true) {
+            themes
+        }
+    }''')
+    assert deorder(result) == {
+        'data': {
+            'sessions': [
+                {'sessionId': 'widgets-1', 'themes': []},
+            ],
+            'parked': [
+                {'themes': []},
+                {'themes': []},
+            ],
+        },
+    }
+
+
+def test_query_filters(client):
+    result = client.execute(r'''{
+        sites(custodian: "brian@splitter.il") {
+            siteId
+        }
+        uci: sessions(siteId: "uci", state: "parked") {
+            sessionId
+        }
+        brian: sessions(custodian: "Brian", parked: true) {
+            sessionId
+        }
+        ready: sessions(state: "ready") {
+            sessionId
+        }
+    }''')
+    assert deorder(result) == {
+        'data': {
+            'sites': [{'siteId': 'ldi'}],
+            'uci': [{'sessionId': 'pantssss'}, {'sessionId': 'pantss1'}],
+            'brian': [{'sessionId': 'pantssss'}],
+            'ready': [{'sessionId': 'widgets-1'}],
+        },
+    }
+
+
+def test_query_pagination(client):
+    query = r'''query ($after: String) {
+        sessions(state: "parked", first: 1, after: $after) {
+            sessionId
+            cursor
+        }
+    }'''
+    first = deorder(client.execute(query))['data']['sessions']
+    assert [x['sessionId'] for x in first] == ['pantssss']
+    second = deorder(client.execute(query, variables={'after': first[0]['cursor']}))['data']['sessions']
+    assert [x['sessionId'] for x in second] == ['pantss1']
+    third = deorder(client.execute(query, variables={'after': second[0]['cursor']}))['data']['sessions']
+    assert third == []
+    result = client.execute(r'''{
+        sites(first: 2) {
+            siteId
+        }
+    }''')
+    assert deorder(result)['data']['sites'] == [{'siteId': 'bow'}, {'siteId': 'uci'}]
+    result = client.execute(r'''{
+        sessions(after: "???") {
+            sessionId
+        }
+    }''')
+    assert result['errors']
+
+
+def test_query_indexed_state(tmpdir):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    repo = lektorium.repo.LocalRepo(
+        FileStorage(tmpdir),
+        FakeServer(),
+        FakeLektor,
+        tmpdir / 'sessions',
+        tmpdir / 'state.sqlite',
+    )
+    loop.run_until_complete(repo.create_site('bow', 'Buy Our Widgets', owner=('Max', 'max@example.com')))
+    loop.run_until_complete(repo.create_site('uvu', 'Ultra Violet Underwear', owner=('Max', 'max@example.com')))
+    parked = repo.create_session('bow', custodian=('Max', 'max@example.com'))
+    repo.park_session(parked)
+    repo.create_session('uvu', custodian=('Max', 'max@example.com'))
+    repo.sessions_initialized = True
+    client = graphene.test.Client(
+        graphene.Schema(query=lektorium.schema.Query, mutation=lektorium.schema.MutationQuery),
+        context={'repo': repo, 'user_permissions': ['user:bow']},
+        executor=AsyncioExecutor(loop=loop),
+    )
+    snapshot = repo.snapshot
+    with unittest.mock.patch.object(snapshot, 'find_sites', wraps=snapshot.find_sites) as find_sites:
+        result = client.execute(r'''{
+            sites(custodian: "max@example.com") { siteId }
+            sessions(custodian: "Max", state: "parked") { sessionId site { siteId } }
+            jobs { event sessionId }
+            latest: jobs(limit: 2) { event }
+        }''')
+    find_sites.assert_called_once_with('max@example.com')
+    assert deorder(result) == {
+        'data': {
+            'sites': [{'siteId': 'bow'}],
+            'sessions': [{'sessionId': parked, 'site': {'siteId': 'bow'}}],
+            'jobs': [
+                {'event': 'parked', 'sessionId': parked},
+                {'event': 'ready', 'sessionId': parked},
+                {'event': 'starting', 'sessionId': parked},
+                {'event': 'site-created', 'sessionId': None},
+            ],
+            'latest': [{'event': 'parked'}, {'event': 'ready'}],
+        },
+    }
@@ -0,0 +1,45 @@
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+from lektorium.utils import lazy_import
+
+
+HEAVY_MODULES = (
+    'aiodocker',
+    'boto3',
+    'lektorium.repo.local.server',
+    'lektorium.repo.local.storage',
+    'pkg_resources',
+    'requests',
+)
+MAX_IMPORT_TIME = float(os.environ.get('LEKTORIUM_MAX_IMPORT_TIME', '1.5'))
+
+
+def import_times(module):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stderr=subprocess.PIPE,
+        check=True,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+    )
+    lines = re.findall(r'^import time:\s+\d+ \|\s+(\d+) \| *(\S+)$', result.stderr.decode(), re.MULTILINE)
+    return {name: int(cumulative) / 1e6 for cumulative, name in lines}
+
+
+def test_app_import_is_lazy():
+    times = import_times('lektorium.app')
+    assert not set(HEAVY_MODULES) & set(times)
+    assert times['lektorium.app'] < MAX_IMPORT_TIME
+
+
+def test_lazy_import():
+    assert lazy_import('os') is os
+    module = lazy_import('json.tool')
+    assert sys.modules['json.tool'] is module
+    assert callable(module.main)
+    with pytest.raises(ImportError):
+        lazy_import('lektorium.nonexistent')
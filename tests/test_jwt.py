@@ -1,9 +1,10 @@
+import asyncio
 import json
 from collections import namedtuple
 
 import pytest
 
-from lektorium.jwt import GraphExecutionError, JWTMiddleware
+from lektorium.jwt import JWKS, GraphExecutionError, JWTMiddleware
 
 
 TEST_TOKEN = (
@@ -124,3 +125,89 @@ async def test_jwt_resolve(aresponses, jwt_middleware, monkeypatch):
     )
     resolve = await jwt_middleware.resolve(test_next, None, info)
     assert resolve.context['userdata'] == ('Max Jekov', 'mj@mail.me')
+
+
+@pytest.mark.asyncio
+async def test_jwt_verification_memoized(aresponses, jwt_middleware, monkeypatch):
+    Info = namedtuple('Info', 'context')
+    Request = namedtuple('Request', 'headers')
+    aresponses.add(
+        jwt_middleware.auth0_domain,
+        '/.well-known/jwks.json',
+        'get',
+        aresponses.Response(
+            status=200,
+            headers={'Content-Type': 'application/json'},
+            body=bytes(json.dumps(TEST_JWK), encoding='utf-8'),
+        ),
+    )
+    decoded = []
+    decode_token = jwt_middleware.decode_token
+
+    def counting_decode_token(token, key):
+        decoded.append(token)
+        return decode_token(token, key)
+
+    monkeypatch.setattr(jwt_middleware, 'decode_token', counting_decode_token)
+    info = Info({'request': Request(TEST_HEADERS)})
+    for _ in range(3):
+        await jwt_middleware.resolve(lambda root, info: info, None, info)
+    assert len(decoded) == 2
+    other_info = Info({'request': Request(TEST_HEADERS)})
+    resolved = await jwt_middleware.resolve(lambda root, info: info, None, other_info)
+    assert resolved.context['userdata'] == ('Max Jekov', 'mj@mail.me')
+    assert len(decoded) == 2
+    jwt_middleware.verified[next(iter(jwt_middleware.verified))] = (None, 0)
+    await jwt_middleware.info(Request(TEST_HEADERS))
+    assert len(decoded) == 4
+
+
+@pytest.mark.asyncio
+async def test_jwks_kid_lookup(aresponses, jwt_middleware):
+    requests = []
+
+    def response_handler(request):
+        requests.append(request)
+        keys = [dict(TEST_JWK, kid=f'key{len(requests)}')]
+        return aresponses.Response(
+            status=200,
+            headers={'Content-Type': 'application/json'},
+            body=bytes(json.dumps({'keys': keys}), encoding='utf-8'),
+        )
+
+    for _ in range(2):
+        aresponses.add(
+            jwt_middleware.auth0_domain,
+            '/.well-known/jwks.json',
+            'get',
+            response_handler,
+        )
+    jwks = jwt_middleware.jwks
+    assert await jwks.key('key1') is jwks.keys['key1']
+    with pytest.raises(GraphExecutionError):
+        await jwks.key('key2')
+    assert len(requests) == 1
+    jwks.fetched -= JWKS.REFETCH_INTERVAL + 1
+    keys = await asyncio.gather(jwks.key('key2'), jwks.key('key2'))
+    assert keys[0] is keys[1]
+    assert len(requests) == 2
+    assert JWKS.token_kid(TEST_TOKEN) is None
+
+
+@pytest.mark.asyncio
+async def test_jwks_refresh_cancellation(jwt_middleware):
+    jwks, fetched = jwt_middleware.jwks, asyncio.Event()
+
+    async def fetch():
+        await fetched.wait()
+        return {'keys': [dict(TEST_JWK, kid='key1')]}
+
+    jwks.fetch = fetch
+    first = asyncio.ensure_future(jwks.key('key1'))
+    second = asyncio.ensure_future(jwks.key('key1'))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    fetched.set()
+    assert await second is jwks.keys['key1']
+    assert first.cancelled()
@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+from lektorium.loaders import DataLoader
+
+
+@pytest.mark.asyncio
+async def test_data_loader_batches():
+    batches = []
+
+    async def batch_load(keys):
+        batches.append(keys)
+        return [KeyError(x) if x == 'missing' else x * 2 for x in keys]
+
+    loader = DataLoader(batch_load)
+    assert await asyncio.gather(loader.load(1), loader.load(2), loader.load(1)) == [2, 4, 2]
+    assert batches == [[1, 2]]
+    assert await loader.load_many([2, 3]) == [4, 6]
+    assert batches == [[1, 2], [3]]
+    with pytest.raises(KeyError):
+        await loader.load('missing')
+
+
+@pytest.mark.asyncio
+async def test_data_loader_batch_failure():
+    async def batch_load(keys):
+        raise RuntimeError('failed')
+
+    loader = DataLoader(batch_load)
+    loader.prime('primed', 1)
+    assert await loader.load('primed') == 1
+    with pytest.raises(RuntimeError):
+        await loader.load_many(['a', 'b'])
@@ -1,9 +1,14 @@
+import asyncio
+import json
+import sqlite3
 import unittest.mock
 
+import async_timeout
 import pytest
 from conftest import git_repo, local_repo
 
-from lektorium.repo import LocalRepo
+from lektorium import app
+from lektorium.repo import DuplicateEditSession, LocalRepo
 from lektorium.repo.local import (
     FakeLektor,
     FakeServer,
@@ -11,6 +16,18 @@ from lektorium.repo.local import (
     LocalLektor,
 )
 from lektorium.repo.local.repo import Session, Site
+from lektorium.repo.local.server import AsyncServer
+from lektorium.repo.local.state import SqliteState
+
+
+class PendingServer(AsyncServer):
+    def __init__(self):
+        super().__init__()
+        self.release = asyncio.Event()
+
+    async def start(self, path, started, session):
+        await self.release.wait()
+        started.set_result(f'http://localhost/{path.name}/')
 
 
 @pytest.fixture(scope='function', params=[local_repo, git_repo])
@@ -86,3 +103,175 @@ async def test_lektor_config_loading(tmpdir):
     repo = LocalRepo(FileStorage(tmpdir), FakeServer(), LocalLektor)
     await repo.create_site('a', 'b')
     LocalRepo(FileStorage(tmpdir), FakeServer(), LocalLektor)
+
+
+@pytest.mark.asyncio
+async def test_state_snapshot(tmpdir):
+    sessions_root, state_path = tmpdir / 'sessions', tmpdir / 'state.json'
+    repo = LocalRepo(FileStorage(tmpdir), FakeServer(), FakeLektor, sessions_root, state_path)
+    await repo.create_site('bow', 'Buy Our Widgets')
+    parked = repo.create_session('bow')
+    repo.park_session(parked)
+    repo.create_session('bow')
+    repo = LocalRepo(FileStorage(tmpdir), FakeServer(), FakeLektor, sessions_root, state_path)
+    assert repo.sessions[parked][0]['custodian'] == LocalRepo.DEFAULT_USER[0]
+    assert len([x for x, _ in repo.sessions.values() if not x.parked]) == 1
+    await repo.init_sessions()
+    await repo.reconciling
+    assert len(repo.sessions) == 2
+    assert all(x.parked for x, _ in repo.sessions.values())
+
+
+@pytest.mark.asyncio
+async def test_state_snapshot_starting(tmpdir):
+    sessions_root, state_path, server = tmpdir / 'sessions', tmpdir / 'state.json', PendingServer()
+    repo = LocalRepo(FileStorage(tmpdir), server, FakeLektor, sessions_root, state_path)
+    await repo.create_site('bow', 'Buy Our Widgets')
+    session_id = repo.create_session('bow')
+    restarted = LocalRepo(FileStorage(tmpdir), FakeServer(), FakeLektor, sessions_root, state_path)
+    assert restarted.sessions[session_id][0]['edit_url'] == 'Starting'
+    assert restarted.active_sessions == {'bow': session_id}
+    server.release.set()
+    await server.started(repo.sessions_root / 'bow' / session_id)
+    await asyncio.sleep(0)
+    restarted = LocalRepo(FileStorage(tmpdir), FakeServer(), FakeLektor, sessions_root, state_path)
+    assert restarted.sessions[session_id][0]['edit_url'] == f'http://localhost/{session_id}/'
+    await app.reconcile_repo(restarted)(None)
+    await restarted.reconciling
+    assert restarted.sessions_initialized
+    assert restarted.sessions[session_id][0].parked
+
+
+@pytest.mark.asyncio
+async def test_shared_state(tmpdir):
+    sessions_root, state_path, server = tmpdir / 'sessions', tmpdir / 'state.sqlite', FakeServer()
+
+    def worker():
+        return LocalRepo(FileStorage(tmpdir), server, FakeLektor, sessions_root, state_path)
+
+    first, second = worker(), worker()
+    assert first.shared and second.shared
+    async with first.transition(site_id='bow'):
+        await first.create_site('bow', 'Buy Our Widgets')
+    assert [x['site_id'] for x in second.sites] == ['bow']
+    async with first.transition(site_id='bow'):
+        session_id = first.create_session('bow')
+    assert second.active_sessions == {} and session_id in second.sessions
+    assert second.active_sessions == {'bow': session_id}
+    async with second.transition(session_id=session_id):
+        second.park_session(session_id)
+    assert [x['session_id'] for x in first.parked_sessions] == [session_id]
+    assert worker().sessions[session_id][0].parked
+    async with first.transition(session_id=session_id):
+        first.unpark_session(session_id)
+        first.destroy_session(session_id)
+    assert session_id not in second.sessions
+
+
+@pytest.mark.asyncio
+async def test_shared_state_starting(tmpdir):
+    sessions_root, state_path, server = tmpdir / 'sessions', tmpdir / 'state.sqlite', PendingServer()
+    first = LocalRepo(FileStorage(tmpdir), server, FakeLektor, sessions_root, state_path)
+    second = LocalRepo(FileStorage(tmpdir), FakeServer(), FakeLektor, sessions_root, state_path)
+    async with first.transition(site_id='bow'):
+        await first.create_site('bow', 'Buy Our Widgets')
+    async with first.transition(site_id='uvu'):
+        await first.create_site('uvu', 'Ultra Violet Underwear')
+    async with first.transition(site_id='bow'):
+        session_id = first.create_session('bow')
+    assert first.find_sessions(parked=False) == [session_id]
+    assert second.find_sessions(parked=False) == [session_id]
+    assert second.sessions[session_id][0]['edit_url'] == 'Starting'
+    async with second.transition(site_id='uvu'):
+        second.create_session('uvu')
+    assert first.refresh()
+    assert callable(first.sessions[session_id][0].data['edit_url'])
+    assert first.active_sessions['bow'] == session_id
+    for worker in (first, second):
+        with pytest.raises(DuplicateEditSession):
+            async with worker.transition(site_id='bow'):
+                worker.create_session('bow')
+    server.release.set()
+    await server.started(first.sessions_root / 'bow' / session_id)
+    await asyncio.sleep(0)
+    assert second.sessions[session_id][0]['edit_url'] == f'http://localhost/{session_id}/'
+    assert sorted(second.find_sessions(['bow'], parked=False)) == [session_id]
+
+
+@pytest.mark.asyncio
+async def test_shared_state_site_locks(tmpdir):
+    sessions_root, state_path = tmpdir / 'sessions', tmpdir / 'state.sqlite'
+
+    def worker():
+        return LocalRepo(FileStorage(tmpdir), FakeServer(), FakeLektor, sessions_root, state_path)
+
+    first, second = worker(), worker()
+    for site_id, name in (('bow', 'Buy Our Widgets'), ('uvu', 'Ultra Violet Underwear')):
+        async with first.transition(site_id=site_id):
+            await first.create_site(site_id, name)
+    async with first.transition(site_id='bow'):
+        async with async_timeout.timeout(1):
+            async with second.transition(site_id='uvu'):
+                other = second.create_session('uvu')
+        with pytest.raises(asyncio.TimeoutError):
+            async with async_timeout.timeout(0.1):
+                async with second.transition(site_id='bow'):
+                    pass
+        session_id = first.create_session('bow')
+    assert second.refresh() and second.active_sessions == {'bow': session_id, 'uvu': other}
+    assert worker().active_sessions == {'bow': session_id, 'uvu': other}
+
+
+@pytest.mark.asyncio
+async def test_sqlite_state_queries(tmpdir):
+    state_path = tmpdir / 'state.sqlite'
+    repo = LocalRepo(FileStorage(tmpdir), FakeServer(), FakeLektor, tmpdir / 'sessions', state_path)
+    await repo.create_site('bow', 'Buy Our Widgets', owner=('Max', 'max@example.com'))
+    await repo.create_site('uvu', 'Ultra Violet Underwear')
+    parked = repo.create_session('bow', custodian=('Max', 'max@example.com'))
+    repo.park_session(parked)
+    active = repo.create_session('bow')
+    other = repo.create_session('uvu', custodian=('Max', 'max@example.com'))
+    assert repo.find_sessions(['bow'], parked=True) == [parked]
+    assert sorted(repo.find_sessions(custodian='max@example.com')) == sorted([parked, other])
+    assert sorted(repo.find_sessions(parked=False)) == sorted([active, other])
+    assert repo.snapshot.find_sites(custodian='Max') == ['bow']
+    assert [x['event'] for x in repo.jobs(session_id=parked)] == ['parked', 'ready', 'starting']
+    assert repo.jobs(site_id='uvu', limit=1)[0]['session_id'] == other
+    assert repo.find_sessions(['bow']) == [parked, active]
+    assert {x['site_id'] for x in repo.jobs(limit=3, site_ids=['bow'])} == {'bow'}
+    plan = repo.snapshot.connect().execute(
+        'EXPLAIN QUERY PLAN SELECT session_id FROM sessions WHERE site_id = ? AND parked = ?',
+        ('bow', 1),
+    ).fetchall()
+    assert 'sessions_site' in str(plan)
+
+
+def test_sqlite_state_migration(tmpdir):
+    path = tmpdir / 'state.sqlite'
+    connection = sqlite3.connect(str(path))
+    for statement in SqliteState.MIGRATIONS[0]:
+        connection.execute(statement)
+    connection.execute("INSERT INTO meta VALUES ('saved', 0)")
+    connection.execute(
+        'INSERT INTO sessions VALUES (?, ?, ?)',
+        ('a', 'bow', json.dumps({'session_id': 'a', 'custodian': 'Max', 'edit_url': None})),
+    )
+    connection.commit()
+    connection.close()
+    state = SqliteState(path)
+    assert state.find_sessions(custodian='Max', parked=True) == ['a']
+    assert state.load() == {'bow': {'a': {'session_id': 'a', 'custodian': 'Max', 'edit_url': None}}}
+
+
+def test_session_index(repo):
+    session_id = repo.create_session('bow')
+    assert repo.active_sessions == {'bow': session_id}
+    repo.park_session(session_id)
+    assert repo.active_sessions == {}
+    assert [x['session_id'] for x in repo.parked_sessions] == [session_id]
+    repo.unpark_session(session_id)
+    assert repo.active_sessions == {'bow': session_id}
+    repo.destroy_session(session_id)
+    assert repo.active_sessions == {}
+    assert session_id not in repo.sessions
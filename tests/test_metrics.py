@@ -0,0 +1,79 @@
+import subprocess
+
+import graphene
+import pytest
+from graphql.execution.executors.asyncio import AsyncioExecutor
+
+from lektorium import metrics
+from lektorium.repo.local import storage
+
+
+def test_histogram_render():
+    registry = metrics.Registry()
+    histogram = registry.histogram('test_seconds', 'Test.', ('operation', 'result'), buckets=(0.1, 1))
+    histogram.observe(0.05, operation='a', result='ok')
+    histogram.observe(0.5, operation='a', result='ok')
+    with pytest.raises(RuntimeError):
+        with histogram.time(operation='b'):
+            raise RuntimeError()
+    with pytest.raises(ValueError):
+        histogram.observe(1, operation='a')
+    lines = registry.render().splitlines()
+    assert lines[:2] == ['# HELP test_seconds Test.', '# TYPE test_seconds histogram']
+    assert 'test_seconds_bucket{operation="a",result="ok",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{operation="a",result="ok",le="+Inf"} 2' in lines
+    assert 'test_seconds_sum{operation="a",result="ok"} 0.55' in lines
+    assert 'test_seconds_count{operation="b",result="error"} 1' in lines
+    assert registry.histogram('test_seconds', 'Other.') is histogram
+
+
+def test_counter_render():
+    registry = metrics.Registry()
+    counter = registry.counter('test_total', 'Test.', ('path',))
+    counter.inc(path='a"b')
+    counter.inc(2, path='a"b')
+    assert 'test_total{path="a\\"b"} 3' in registry.render().splitlines()
+
+
+def count(histogram, *key):
+    return sum(histogram.values.get(key, [0, 0])[:-1])
+
+
+def test_command_metrics(tmpdir):
+    before = count(metrics.COMMAND_SECONDS, 'git init', 'ok')
+    storage.run('git init .', cwd=tmpdir)
+    assert count(metrics.COMMAND_SECONDS, 'git init', 'ok') == before + 1
+    with pytest.raises(subprocess.CalledProcessError):
+        storage.run_out('git unknown-command', cwd=tmpdir, stderr=subprocess.DEVNULL)
+    assert count(metrics.COMMAND_SECONDS, 'git unknown-command', 'error') >= 1
+
+
+@pytest.mark.asyncio
+async def test_resolver_metrics(event_loop):
+    class Query(graphene.ObjectType):
+        plain = graphene.String()
+        delayed = graphene.String()
+
+        def resolve_plain(self, info):
+            return 'plain'
+
+        async def resolve_delayed(self, info):
+            raise RuntimeError('delayed')
+
+    histogram = metrics.Histogram('test_resolver_seconds', 'Test.', ('type', 'field', 'result'))
+    result = await graphene.Schema(query=Query).execute(
+        '{ plain delayed }',
+        executor=AsyncioExecutor(loop=event_loop),
+        middleware=[metrics.ResolverMetrics(histogram)],
+        return_promise=True,
+    )
+    assert result.data == {'plain': 'plain', 'delayed': None}
+    assert count(histogram, 'Query', 'plain', 'ok') == 1
+    assert count(histogram, 'Query', 'delayed', 'error') == 1
+
+
+@pytest.mark.asyncio
+async def test_metrics_handler():
+    response = await metrics.REGISTRY.handler(None)
+    assert response.headers['Content-Type'] == metrics.Registry.CONTENT_TYPE
+    assert '# TYPE lektorium_mutation_seconds histogram' in response.text
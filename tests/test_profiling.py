@@ -0,0 +1,117 @@
+import asyncio
+import json
+import threading
+import time
+
+import aiohttp.web
+import pytest
+
+from lektorium import metrics, profiling
+
+
+class Request:
+    def __init__(self, **query):
+        self.query = query
+
+
+def busy_worker(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampling_profiler():
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_worker, args=(stop,), name='busy')
+    thread.start()
+    profiler = profiling.SamplingProfiler(interval=0.001)
+    try:
+        profiler.start()
+        with pytest.raises(RuntimeError):
+            profiler.start()
+        time.sleep(0.1)
+        collapsed = profiler.stop()
+    finally:
+        stop.set()
+        thread.join()
+    assert not profiler.running
+    assert profiler.sample_count > 0
+    lines = [x for x in collapsed.splitlines() if x.startswith('busy;')]
+    assert lines and all('busy_worker' in x for x in lines)
+    assert all(x.rsplit(' ', 1)[1].isdigit() for x in collapsed.splitlines())
+
+
+@pytest.mark.asyncio
+async def test_profile_handler():
+    handlers = profiling.DebugHandlers(profiling.SamplingProfiler(interval=0.001))
+    response = await handlers.profile(Request(seconds='0.05'))
+    assert response.content_type == 'text/plain'
+    assert int(response.headers['X-Profile-Samples']) > 0
+    assert 'run_forever' in response.text
+    with pytest.raises(aiohttp.web.HTTPBadRequest):
+        await handlers.profile(Request(seconds='soon'))
+
+
+@pytest.mark.asyncio
+async def test_profile_start_stop():
+    handlers = profiling.DebugHandlers(profiling.SamplingProfiler(interval=0.001))
+    with pytest.raises(aiohttp.web.HTTPConflict):
+        await handlers.profile_stop(Request())
+    response = await handlers.profile_start(Request())
+    assert response.status == 202
+    with pytest.raises(aiohttp.web.HTTPConflict):
+        await handlers.profile_start(Request())
+    with pytest.raises(aiohttp.web.HTTPConflict):
+        await handlers.profile(Request(seconds='1'))
+    await asyncio.sleep(0.02)
+    response = await handlers.profile_stop(Request())
+    assert not handlers.profiler.running
+    assert response.text
+
+
+@pytest.mark.asyncio
+async def test_loop_handler():
+    assert len(await profiling.loop_lag(3)) == 3
+    sleeper = asyncio.ensure_future(asyncio.sleep(10))
+    await asyncio.sleep(0)
+    try:
+        response = await profiling.DebugHandlers().loop(Request())
+    finally:
+        sleeper.cancel()
+    data = json.loads(response.text)
+    assert data['lag']['max'] >= 0
+    assert data['task_count'] == len(data['tasks'])
+    assert any(x['coroutine'] == 'sleep' for x in data['tasks'])
+
+
+def block_loop(seconds):
+    time.sleep(seconds)
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor():
+    monitor = profiling.LoopMonitor(interval=0.01, threshold=0.05)
+    blocked = metrics.LOOP_BLOCKED.values.get((), 0)
+    monitor.start()
+    try:
+        with pytest.raises(RuntimeError):
+            monitor.start()
+        await asyncio.sleep(0.05)
+        block_loop(0.2)
+        await asyncio.sleep(0.05)
+    finally:
+        await monitor.stop()
+    assert monitor.task is None
+    assert len(monitor.reports) == 1
+    assert 'block_loop' in monitor.reports[0]['stack']
+    assert monitor.reports[0]['blocked'] > 0.05
+    assert metrics.LOOP_BLOCKED.values[()] == blocked + 1
+    percentiles = monitor.percentiles()
+    assert percentiles[1] >= 0.15
+    assert percentiles[0.5] < 0.15
+    assert metrics.LOOP_LAG_SECONDS.values[('1',)] == percentiles[1]
+    assert 'lektorium_event_loop_lag_seconds{quantile="0.99"}' in metrics.REGISTRY.render()
+    response = await profiling.DebugHandlers(monitor=monitor).loop(Request())
+    stats = json.loads(response.text)['monitor']
+    assert not stats['running']
+    assert stats['lag']['1'] == percentiles[1]
+    assert 'block_loop' in stats['blocked'][0]['stack']
@@ -0,0 +1,140 @@
+import asyncio
+
+import aiohttp
+import aiohttp.web
+import pytest
+
+from lektorium import proxy
+
+
+class Message:
+    type = aiohttp.WSMsgType.BINARY
+
+    def __init__(self, data):
+        self.data = data
+
+
+class WebSocket:
+    def __init__(self, messages=()):
+        self.incoming = asyncio.Queue()
+        for message in messages:
+            self.incoming.put_nowait(message)
+        self.sent = []
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.incoming.get()
+        if message is None:
+            raise StopAsyncIteration
+        return Message(message)
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def close(self):
+        self.closed = True
+        self.incoming.put_nowait(None)
+
+
+@pytest.mark.asyncio
+async def test_read_frame_coalesces():
+    reader = asyncio.StreamReader()
+    for _ in range(100):
+        reader.feed_data(b'x' * 100)
+    assert len(await proxy.read_frame(reader, read_size=1024)) == 10000
+    reader.feed_data(b'y')
+    reader.feed_eof()
+    assert await proxy.read_frame(reader) == b'y'
+    assert await proxy.read_frame(reader) == b''
+
+
+@pytest.mark.asyncio
+async def test_streamer(tmpdir):
+    received = []
+
+    async def echo(reader, writer):
+        data = await reader.read(1024)
+        received.append(data)
+        writer.write(data * 3)
+        await writer.drain()
+        writer.close()
+
+    path = str(tmpdir / 'docker.sock')
+    server = await asyncio.start_unix_server(echo, path)
+    reader, writer = await asyncio.open_unix_connection(path)
+    ws, stats = WebSocket([b'ping']), proxy.ProxyStats()
+    await asyncio.wait_for(proxy.streamer(ws, reader, writer, stats), 5)
+    server.close()
+    assert received == [b'ping']
+    assert b''.join(ws.sent) == b'pingpingping'
+    assert ws.closed
+    assert stats.counters['ws2tcp_bytes'] == 4
+    assert stats.counters['tcp2ws_bytes'] == 12
+    assert set(stats.throughput) == {'tcp2ws', 'ws2tcp'}
+
+
+@pytest.mark.asyncio
+async def test_docker_proxy_multiplex(tmpdir):
+    async def echo(reader, writer):
+        while True:
+            data = await reader.read(1024)
+            if not data:
+                break
+            writer.write(data.upper())
+            await writer.drain()
+        writer.close()
+
+    path = str(tmpdir / 'docker.sock')
+    server = await asyncio.start_unix_server(echo, path)
+    docker_proxy = proxy.DockerProxy(path, max_streams=2)
+    header = docker_proxy.STREAM_HEADER.pack
+    ws = WebSocket([header(1) + b'one', header(2) + b'two', header(3) + b'three'])
+    task = asyncio.ensure_future(docker_proxy.multiplex(ws, proxy.ProxyStats()))
+    while len(ws.sent) < 3:
+        await asyncio.sleep(0.01)
+    assert sorted(ws.sent) == [header(1) + b'ONE', header(2) + b'TWO', header(3)]
+    await ws.close()
+    await asyncio.wait_for(task, 5)
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_docker_proxy_multiplex_stream_failure(tmpdir, caplog):
+    connections = []
+
+    async def echo(reader, writer):
+        connections.append(writer)
+        writer.write(await reader.read(1024))
+        await writer.drain()
+
+    class FailingWebSocket(WebSocket):
+        async def send_bytes(self, data):
+            raise RuntimeError('send failed')
+
+    path = str(tmpdir / 'docker.sock')
+    server = await asyncio.start_unix_server(echo, path)
+    docker_proxy = proxy.DockerProxy(path)
+    ws = FailingWebSocket([docker_proxy.STREAM_HEADER.pack(1) + b'one'])
+    task = asyncio.ensure_future(docker_proxy.multiplex(ws, proxy.ProxyStats()))
+    while not connections:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.05)
+    await ws.close()
+    await asyncio.wait_for(task, 5)
+    server.close()
+    assert 'Stream 1 failed' in caplog.text
+    assert 'send failed' in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_docker_proxy_limits():
+    docker_proxy = proxy.DockerProxy('/nonexistent', max_connections=1, idle_timeout=0.01)
+    docker_proxy.connections.add(WebSocket())
+    with pytest.raises(aiohttp.web.HTTPServiceUnavailable):
+        await docker_proxy.handler(None)
+    ws = WebSocket()
+    await asyncio.wait_for(docker_proxy.watchdog(ws, proxy.ProxyStats()), 1)
+    assert ws.closed
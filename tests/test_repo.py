@@ -1,3 +1,4 @@
+import asyncio
 import copy
 
 import pytest
@@ -152,3 +153,47 @@ def test_releasing(repo, merge_requests):
 def test_request_release(repo):
     session_id = repo.create_session('uci')
     repo.request_release(session_id)
+
+
+@pytest.mark.asyncio
+async def test_transitions_serialized_per_key(repo):
+    events = []
+
+    async def transition(name, **kwargs):
+        async with repo.transition(**kwargs):
+            events.append(f'{name}-start')
+            await asyncio.sleep(0.01)
+            events.append(f'{name}-end')
+
+    parked_id = repo.create_session('uci')
+    repo.park_session(parked_id)
+    session_id = repo.create_session('uci')
+    await asyncio.gather(
+        transition('a', site_id='uci'),
+        transition('b', site_id='uci'),
+        transition('c', session_id=session_id),
+        transition('d', session_id=session_id),
+        transition('e', session_id=parked_id),
+        transition('f', site_id='bow'),
+    )
+    assert events.index('a-end') < events.index('b-start')
+    assert events.index('c-end') < events.index('d-start')
+    assert events.index('c-start') < events.index('a-end')
+    assert events.index('e-start') < events.index('c-end')
+    assert events.index('f-start') < events.index('a-end')
+    assert not len(repo.locks)
+
+
+@pytest.mark.asyncio
+async def test_session_events(repo):
+    with repo.events.subscribe() as queue:
+        session_id = repo.create_session('uci')
+        repo.park_session(session_id)
+        repo.unpark_session(session_id)
+        repo.destroy_session(session_id)
+        events = []
+        while not queue.empty():
+            events.append(queue.get_nowait())
+    assert not len(repo.events)
+    assert {(x['site_id'], x['session_id']) for x in events} == {('uci', session_id)}
+    assert [x['event'] for x in events if x['event'] != 'starting'] == ['ready', 'parked', 'ready', 'destroyed']
@@ -1,11 +1,15 @@
 import asyncio
+import concurrent.futures
+import pathlib
 import tempfile
+import threading
 from unittest.mock import MagicMock
 
 import async_timeout
 import pytest
 
 from lektorium.repo.local import AsyncLocalServer, LocalLektor
+from lektorium.repo.local.server import AsyncServer, BuildCache, LektorWorkerPool
 
 
 class AsyncTestServer(AsyncLocalServer):
@@ -57,3 +61,105 @@ async def test_start_stop_lektor(tmpdir):
     async with async_timeout.timeout(2):
         while not finalizer.call_count:
             await asyncio.sleep(0.1)
+
+
+@pytest.mark.asyncio
+async def test_start_stop_pooled_server():
+    with tempfile.TemporaryDirectory() as tmp:
+        server = AsyncTestServer('false')
+        server.pool = LektorWorkerPool(1, script=(
+            'import sys, time\n'
+            'sys.stdin.readline()\n'
+            'print("Finished prune")\n'
+            'time.sleep(1)\n'
+        ))
+        server.warm_up()
+        result = server.serve_lektor(tmp)
+        while callable(result):
+            await asyncio.sleep(0.1)
+            result = result()[0]
+        assert result == 'http://localhost:5000/'
+        async with async_timeout.timeout(2):
+            while len(server.pool.idle) != 1:
+                await asyncio.sleep(0.1)
+        finalizer = MagicMock()
+        server.stop_server(tmp, finalizer=finalizer)
+        async with async_timeout.timeout(2):
+            while not finalizer.call_count:
+                await asyncio.sleep(0.1)
+
+
+def test_build_cache(tmpdir):
+    cache = BuildCache(tmpdir / 'cache')
+    first, second = pathlib.Path('/sessions/a/first'), pathlib.Path('/sessions/a/second')
+    assert not cache.seed(first, 'a').exists()
+    cache.output_path(first).mkdir(parents=True)
+    (cache.output_path(first) / 'index.html').write_text('built')
+    cache.refresh(first, 'a')
+    assert (cache.site_snapshot('a') / 'index.html').read_text() == 'built'
+    assert (cache.seed(second, 'a') / 'index.html').read_text() == 'built'
+    (cache.output_path(second) / 'index.html').write_text('changed')
+    assert (cache.site_snapshot('a') / 'index.html').read_text() == 'built'
+    cache.drop(first)
+    assert not cache.output_path(first).exists()
+
+
+class SlowStopServer(AsyncServer):
+    def __init__(self, build_cache):
+        super().__init__(build_cache=build_cache)
+        self.stopped = asyncio.Event()
+        self.events = []
+
+    async def start(self, path, started, session):
+        started.set_result('http://localhost/')
+
+    async def stop(self, path, finalizer=None):
+        await self.stopped.wait()
+        self.events.append('stopped')
+
+
+@pytest.mark.asyncio
+async def test_release_build_cache(tmpdir):
+    server = SlowStopServer(tmpdir / 'cache')
+    path = pathlib.Path('/sessions/a/first')
+    output = server.build_cache.output_path(path)
+    output.mkdir(parents=True)
+    (output / 'index.html').write_text('built')
+    refresh = server.build_cache.refresh
+
+    def record_refresh(*args):
+        server.events.append(('refresh', threading.current_thread() is threading.main_thread()))
+        refresh(*args)
+
+    server.build_cache.refresh = record_refresh
+    server.stop_server(path)
+    server.drop_build_cache(path, 'a')
+    await asyncio.sleep(0.05)
+    assert server.events == []
+    server.stopped.set()
+    async with async_timeout.timeout(2):
+        while output.exists():
+            await asyncio.sleep(0.01)
+    assert server.events == ['stopped', ('refresh', False)]
+    assert (server.build_cache.site_snapshot('a') / 'index.html').read_text() == 'built'
+    assert server.stopping == {}
+
+
+def test_build_cache_concurrent_refresh(tmpdir):
+    cache = BuildCache(tmpdir / 'cache')
+    paths = [pathlib.Path(f'/sessions/a/{x}') for x in range(8)]
+    for path in paths:
+        cache.output_path(path).mkdir(parents=True)
+        (cache.output_path(path) / 'index.html').write_text(path.name)
+    copy, barrier = cache.copy, threading.Barrier(len(paths))
+
+    def copy_together(source, target):
+        copy(source, target)
+        barrier.wait()
+
+    cache.copy = copy_together
+    with concurrent.futures.ThreadPoolExecutor(len(paths)) as executor:
+        for result in [executor.submit(cache.refresh, x, 'a') for x in paths]:
+            result.result()
+    assert (cache.site_snapshot('a') / 'index.html').read_text() in {x.name for x in paths}
+    assert [x.name for x in cache.site_snapshot('a').parent.iterdir()] == ['a']
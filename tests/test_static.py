@@ -0,0 +1,47 @@
+import gzip
+
+import pytest
+
+from lektorium.static import StaticAssets
+
+
+class Request:
+    def __init__(self, path, query=None, headers=None):
+        self.path = path
+        self.query = query or {}
+        self.headers = headers or {}
+
+
+@pytest.fixture
+def assets(tmpdir):
+    for directory in ('public', 'scripts', 'components'):
+        tmpdir.mkdir(directory)
+    (tmpdir / 'public' / 'index.html').write('<script src="/scripts/main.js"></script>')
+    (tmpdir / 'scripts' / 'main.js').write("httpVueLoader('/components/App.vue');\n" * 20)
+    (tmpdir / 'components' / 'App.vue').write("httpVueLoader('/components/App.vue')")
+    return StaticAssets(tmpdir, prefixes=('scripts', 'components'))
+
+
+@pytest.mark.asyncio
+async def test_static_assets(assets):
+    app, main = assets.assets['/components/App.vue'], assets.assets['/scripts/main.js']
+    assert app.body == b"httpVueLoader('/components/App.vue')"
+    assert f"'/components/App.vue?v={app.digest}'".encode() in main.body
+    assert f'/scripts/main.js?v={main.digest}'.encode() in assets.index.body
+
+    response = await assets.handler(Request('/scripts/main.js', headers={'Accept-Encoding': 'gzip, deflate'}))
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert gzip.decompress(response.body) == main.body
+
+    response = await assets.handler(Request('/scripts/main.js', query={'v': main.digest}))
+    assert 'Content-Encoding' not in response.headers
+    assert 'immutable' in response.headers['Cache-Control']
+    assert response.body == main.body
+
+    etag = response.headers['ETag']
+    response = await assets.handler(Request('/scripts/main.js', headers={'If-None-Match': etag}))
+    assert response.status == 304
+
+    response = await assets.index_handler(Request('/'))
+    assert response.body == assets.index.body
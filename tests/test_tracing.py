@@ -0,0 +1,101 @@
+import json
+import logging
+
+import aiohttp.web
+import pytest
+
+from lektorium import tracing
+
+
+class Request:
+    method = 'GET'
+    path = '/graphql'
+
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+@pytest.fixture
+def tracer():
+    tracer = tracing.Tracer()
+    spans = []
+
+    class Collector:
+        add = spans.append
+
+        def flush(self):
+            pass
+
+    tracer.processors.append(Collector())
+    tracer.spans = spans
+    return tracer
+
+
+@pytest.mark.asyncio
+async def test_nested_spans(tracer):
+    with pytest.raises(RuntimeError):
+        with tracer.span('mutation', site_id='bow') as parent:
+            with tracer.span('command', command='git clone') as child:
+                pass
+            assert await tracing.run_in_executor(tracing.current_span) is parent
+            raise RuntimeError('failed')
+    assert tracing.current_span() is None
+    assert child.trace_id == parent.trace_id and child.parent_id == parent.span_id
+    assert [x.name for x in tracer.spans] == ['command', 'mutation']
+    assert parent.error == "RuntimeError('failed')" and child.error is None
+    assert parent.attributes == {'site_id': 'bow'}
+
+
+def test_exporters(tmpdir, tracer):
+    with tracer.span('outer'):
+        with tracer.span('inner', count=3, ok=True):
+            pass
+    path = str(tmpdir / 'trace.jsonl')
+    tracing.BatchProcessor(tracing.FileExporter(path)).export(tracer.spans)
+    with open(path) as trace_file:
+        exported = [json.loads(x) for x in trace_file]
+    assert [x['name'] for x in exported] == ['inner', 'outer']
+    assert exported[0]['parent_id'] == exported[1]['span_id']
+    exporter = tracing.OTLPExporter('http://collector:4318')
+    assert exporter.endpoint == 'http://collector:4318/v1/traces'
+    spans = exporter.payload(tracer.spans)['resourceSpans'][0]['scopeSpans'][0]['spans']
+    assert spans[0]['parentSpanId'] == spans[1]['spanId']
+    assert {'key': 'count', 'value': {'intValue': '3'}} in spans[0]['attributes']
+    assert spans[1]['status'] == {'code': 1}
+
+
+@pytest.mark.asyncio
+async def test_request_middleware(caplog):
+    seen = {}
+
+    async def handler(request):
+        with tracing.span('graphql') as current:
+            seen['span'] = current
+            logging.getLogger('lektorium').info('handled')
+        return aiohttp.web.Response(text='ok')
+
+    caplog.handler.addFilter(tracing.RequestIdFilter())
+    with caplog.at_level(logging.INFO):
+        response = await tracing.request_middleware(Request({'X-Request-ID': 'abc-1'}), handler)
+    assert response.headers['X-Request-ID'] == 'abc-1'
+    assert seen['span'].attributes['request_id'] == 'abc-1'
+    assert caplog.records[-1].request_id == 'abc-1'
+    assert caplog.records[-1].trace_id == seen['span'].trace_id
+    response = await tracing.request_middleware(Request({'X-Request-ID': 'bad id\n'}), handler)
+    assert len(response.headers['X-Request-ID']) == 32
+    assert tracing.REQUEST_ID.get() is None
+
+
+@pytest.mark.asyncio
+async def test_request_middleware_http_exception():
+    spans = []
+
+    async def handler(request):
+        spans.append(tracing.current_span())
+        raise aiohttp.web.HTTPForbidden()
+
+    with pytest.raises(aiohttp.web.HTTPForbidden) as exc_info:
+        await tracing.request_middleware(Request({'X-Request-ID': 'abc-2'}), handler)
+    assert exc_info.value.headers['X-Request-ID'] == 'abc-2'
+    assert spans[0].attributes['status'] == 403
+    assert tracing.REQUEST_ID.get() is None
@@ -0,0 +1,129 @@
+import copy
+import hashlib
+import json
+
+import graphene
+import pytest
+from graphql.execution.executors.asyncio import AsyncioExecutor
+
+import lektorium.repo
+import lektorium.schema
+from lektorium.auth0 import FakeAuth0Client
+from lektorium.cost import CostLimiter, QueryCost
+from lektorium.view import DocumentCache, GraphQLView, PersistedQueries
+
+
+class Request:
+    content_type = 'application/json'
+
+    def __init__(self, data, method='POST', query=None, headers=None):
+        self.data = data
+        self.method = method
+        self.query = query or {}
+        self.headers = headers or {}
+
+    async def text(self):
+        return json.dumps(self.data)
+
+
+@pytest.fixture
+def view(event_loop):
+    return GraphQLView(
+        schema=graphene.Schema(
+            query=lektorium.schema.Query,
+            mutation=lektorium.schema.MutationQuery,
+        ),
+        executor=AsyncioExecutor(loop=event_loop),
+        context=dict(
+            repo=lektorium.repo.ListRepo(copy.deepcopy(lektorium.repo.SITES)),
+            auth0_client=FakeAuth0Client(),
+            user_permissions=['admin'],
+        ),
+    )
+
+
+async def execute(view, data, **kwargs):
+    response = await view(Request(data, **kwargs))
+    return response.status, json.loads(response.text)
+
+
+def test_document_cache():
+    schema = graphene.Schema(query=lektorium.schema.Query)
+    backend = DocumentCache(size=1)
+    document = backend.document_from_string(schema, '{ sites { siteId } }')
+    assert backend.document_from_string(schema, '{ sites { siteId } }') is document
+    assert backend.document_from_string(schema, '{ unknown }').execute().invalid
+    assert len(backend) == 1
+
+
+def test_persisted_queries():
+    queries = PersistedQueries()
+    query = '{ sites { siteId } }'
+    key = hashlib.sha256(query.encode()).hexdigest()
+    extensions = {'persistedQuery': {'version': 1, 'sha256Hash': key}}
+    with pytest.raises(Exception, match='PersistedQueryNotFound'):
+        queries.resolve({'extensions': extensions}, {})
+    assert queries.resolve({'query': query, 'extensions': extensions}, {})['query'] == query
+    assert queries.resolve({}, {'extensions': json.dumps(extensions)})['query'] == query
+    with pytest.raises(Exception, match='does not match'):
+        queries.resolve({'query': '{ sessions { sessionId } }', 'extensions': extensions}, {})
+
+
+@pytest.mark.asyncio
+async def test_response_cache(view):
+    query = {'query': '{ availablePermissions { value } }'}
+    status, result = await execute(view, query)
+    assert status == 200
+    assert len(view.response_cache) == 1
+    view.context['repo'].data.pop()
+    assert await execute(view, query) == (status, result)
+    await execute(view, {'query': 'mutation { createSite(siteId: "x", siteName: "x") { ok } }'})
+    assert not len(view.response_cache)
+    _, updated = await execute(view, query)
+    assert updated != result
+    await execute(view, {'query': '{ sites { siteId } }'})
+    assert len(view.response_cache) == 1
+
+
+def test_query_cost():
+    schema = graphene.Schema(query=lektorium.schema.Query, mutation=lektorium.schema.MutationQuery)
+    cost, backend = QueryCost(schema), DocumentCache()
+
+    def analyze(query, **kwargs):
+        return cost.analyze(backend.document_from_string(schema, query), **kwargs)
+
+    assert analyze('{ sites { siteId siteName } }') == (21, 2)
+    assert analyze('query ($n: Int) { sites(first: $n) { siteId } }', variables={'n': 3}) == (4, 2)
+    assert analyze('{ a: themes { name } b: themes { name } }') == (2 * (20 + 10 * 1), 2)
+    assert analyze('{ ...f } fragment f on Query { sessions { themes } }') == (51, 2)
+    assert analyze('{ sessions { site { sessions { site { siteId } } } } }') == (1 + 10 * (1 + 1 + 10 * 2), 5)
+    assert analyze('mutation { parkSession(sessionId: "x") { ok } }') == (21, 2)
+    nested = '{{ sessions {{ {0} site {{ sessions {{ {0} site {{ sessions {{ {0} }} }} }} }} }} }}'
+    spread = analyze(nested.format('...S') + ' fragment S on Session { site { siteId } }')
+    assert spread == analyze(nested.format('site { siteId }'))
+    assert spread[0] > GraphQLView.MAX_COST
+
+
+def test_cost_limiter():
+    limiter = CostLimiter(rate=10, burst=100, max_delay=1)
+    assert limiter.reserve('a', 100) == 0
+    assert limiter.reserve('a', 5) == pytest.approx(0.5, abs=0.1)
+    assert limiter.reserve('a', 100) > 1
+    assert limiter.reserve('b', 100) == 0
+    assert len(limiter) == 2
+
+
+@pytest.mark.asyncio
+async def test_query_limits(view):
+    query = '{ sessions { site { sessions { site { sessions { siteName } } } } } }'
+    status, result = await execute(view, {'query': query})
+    assert status == 400
+    assert 'exceeds' in result['errors'][0]['message']
+    view.graphiql = True
+    status, result = await execute(view, {}, method='GET', query={'query': query}, headers={'accept': '*/*'})
+    assert status == 400
+    assert 'exceeds' in result['errors'][0]['message']
+    view.limiter = CostLimiter(rate=1, burst=30, max_delay=1)
+    assert (await execute(view, {'query': '{ sites { siteId siteName } }'}))[0] == 200
+    status, _ = await execute(view, {'query': '{ sites { siteId siteName } }'})
+    assert status == 429